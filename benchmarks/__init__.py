@@ -0,0 +1,9 @@
+"""
+Throughput benchmarks for FTPRelayer.
+
+These are not shipped with the package, run them from a source checkout:
+
+    python -m benchmarks.relay --workload small --target ftp
+
+See ``python -m benchmarks.relay --help`` for the available knobs.
+"""
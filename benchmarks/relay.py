@@ -0,0 +1,291 @@
+"""
+Measures how fast a real :class:`ftprelayer.Application` relays files to a
+local FTP, SFTP or WebDAV stand-in server.
+
+Reports files/sec, MB/sec, arrival-to-upload latency percentiles, peak RSS
+and CPU time of the relaying process and compares them against the stored
+baselines, exiting with status 1 if any figure regressed more than the
+allowed tolerance.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import multiprocessing
+import resource
+import tempfile
+from optparse import OptionParser
+try:
+    import queue
+except ImportError:
+    # support python < 3
+    import Queue as queue
+
+from ftprelayer import (Application, Relayer, FTPUploader, DAVUploader,
+                        SCPUploader)
+
+from .servers import StandInServer, USERNAME, PASSWORD
+from .workloads import WORKLOADS, Generator, scaled, total_files, total_bytes
+
+MB = 1024.*1024
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Metrics where a bigger figure is better, all others are better smaller
+HIGHER_IS_BETTER = ('files_per_sec', 'mb_per_sec')
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile.
+
+        >>> percentile([4, 1, 3, 2], 50)
+        2
+        >>> percentile([4, 1, 3, 2], 100)
+        4
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(0, int(math.ceil(p/100.*len(values))) - 1)
+    return values[min(rank, len(values)-1)]
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _make_uploader(target, port):
+    if target == 'ftp':
+        import ftplib
+        import ftputil
+        class Session(ftplib.FTP):
+            def __init__(self, host, user, password):
+                ftplib.FTP.__init__(self)
+                self.connect(host, port)
+                self.login(user, password)
+        def FTPHost(host, user, password):
+            return ftputil.FTPHost(host, user, password,
+                                   session_factory=Session)
+        uploader = FTPUploader('127.0.0.1', USERNAME, PASSWORD, '/')
+        uploader.FTPHost = FTPHost
+        return uploader
+    elif target == 'dav':
+        return DAVUploader('http://127.0.0.1:%d/' % port, USERNAME, PASSWORD)
+    elif target == 'sftp':
+        return SCPUploader('127.0.0.1', USERNAME, PASSWORD, '/', port=port,
+                           missing_host_key='auto_add')
+    raise ValueError("Unknown target %r" % target)
+
+
+def run(workload, target, latency=None, bandwidth=None, scale=1.0,
+        timeout=600):
+    """
+    Runs a single benchmark scenario and returns a dict with its figures.
+    """
+    bursts = scaled(WORKLOADS[workload], scale)
+    expected = total_files(bursts)
+    workdir = tempfile.mkdtemp(prefix='ftprelayer-bench-')
+    try:
+        incoming = os.path.join(workdir, 'incoming')
+        server_root = os.path.join(workdir, 'server')
+        os.makedirs(incoming)
+        os.makedirs(server_root)
+
+        server = StandInServer(target, server_root, latency, bandwidth)
+        server.start()
+        try:
+            app = Application()
+            app.add_relayer(Relayer('bench', _make_uploader(target, server.port),
+                                    [os.path.join(incoming, '*')]))
+            app.start()
+            try:
+                generator = Generator(bursts, incoming)
+                cpu_start = _cpu_seconds()
+                generator.start()
+                arrivals, receipts = _collect(generator.arrivals,
+                                              server.received, expected,
+                                              timeout)
+                cpu = _cpu_seconds() - cpu_start
+                generator.join()
+            finally:
+                app.stop()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return _report(arrivals, receipts, cpu, total_bytes(bursts))
+
+def _run_child(results, args):
+    try:
+        results.put(run(*args))
+    except Exception as e:
+        results.put(e)
+
+def run_isolated(*args):
+    """
+    Like :func:`run` but in a fresh process so the peak RSS figure belongs
+    to this scenario only.
+    """
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_child, args=(results, args))
+    child.start()
+    result = _get_result(child, results)
+    child.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def _get_result(child, results, poll=1):
+    while True:
+        alive = child.is_alive()
+        try:
+            return results.get(True, poll)
+        except queue.Empty:
+            # It may have been killed (eg: out of memory) before reporting.
+            # It was checked before waiting so a result it put right before
+            # exiting is not missed.
+            if not alive:
+                raise RuntimeError("Scenario process died with exit code %s"
+                                   % child.exitcode)
+
+def _collect(arrivals_queue, received_queue, expected, timeout):
+    arrivals, receipts = {}, {}
+    deadline = time.time() + timeout
+    while len(receipts) < expected:
+        if time.time() > deadline:
+            raise RuntimeError("Timed out with %d/%d files relayed"
+                               % (len(receipts), expected))
+        _drain(arrivals_queue, arrivals)
+        try:
+            name, size, ts = received_queue.get(True, .1)
+        except queue.Empty:
+            continue
+        receipts[name] = ts
+    _drain(arrivals_queue, arrivals)
+    return arrivals, receipts
+
+def _drain(q, into):
+    while True:
+        try:
+            name, size, ts = q.get_nowait()
+        except queue.Empty:
+            return
+        into[name] = ts
+
+def _report(arrivals, receipts, cpu, nbytes):
+    latencies = [receipts[name] - arrivals[name] for name in receipts]
+    elapsed = max(receipts.values()) - min(arrivals.values())
+    return {
+        'files': len(receipts),
+        'elapsed': elapsed,
+        'files_per_sec': len(receipts)/elapsed,
+        'mb_per_sec': nbytes/MB/elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies),
+        'peak_rss_kb': _peak_rss_kb(),
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu/(nbytes/MB/1024),
+        }
+
+
+def scenario_key(workload, target, latency, bandwidth, scale):
+    return '%s/%s/latency=%s/bandwidth=%s/scale=%s' % (
+        workload, target, latency, bandwidth, scale)
+
+def compare(result, baseline, tolerance):
+    """
+    Returns a list of ``(metric, baseline, current)`` for every figure which
+    is worse than the baseline by more than ``tolerance`` (a fraction).
+
+        >>> compare({'mb_per_sec': 8., 'cpu_seconds': 1.},
+        ...         {'mb_per_sec': 10., 'cpu_seconds': 1.}, .1)
+        [('mb_per_sec', 10.0, 8.0)]
+    """
+    regressions = []
+    for metric in sorted(baseline):
+        if metric not in result or metric in ('files', 'elapsed'):
+            continue
+        old, new = baseline[metric], result[metric]
+        if metric in HIGHER_IS_BETTER:
+            worse = new < old*(1-tolerance)
+        else:
+            worse = new > old*(1+tolerance)
+        if worse:
+            regressions.append((metric, old, new))
+    return regressions
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_baselines(path, baselines):
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def _parser():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--workload', action='append', choices=sorted(WORKLOADS),
+                      help="Workload to run, may be repeated "
+                           "(default: all of %s)" % ', '.join(sorted(WORKLOADS)))
+    parser.add_option('--target', action='append',
+                      choices=['ftp', 'dav', 'sftp'],
+                      help="Server to relay to, may be repeated "
+                           "(default: ftp and dav)")
+    parser.add_option('--latency', type='float', default=None,
+                      help="Delay in ms injected in every server command")
+    parser.add_option('--bandwidth', type='float', default=None,
+                      help="Server-side upload cap in MB/sec")
+    parser.add_option('--scale', type='float', default=1.0,
+                      help="Multiplies the number of files in each workload")
+    parser.add_option('--timeout', type='float', default=600,
+                      help="Seconds to wait for a scenario to complete")
+    parser.add_option('--baseline', default=DEFAULT_BASELINE,
+                      help="JSON file with the stored baselines")
+    parser.add_option('--save-baseline', action='store_true', default=False,
+                      help="Store the results as the new baselines")
+    parser.add_option('--tolerance', type='float', default=.2,
+                      help="Allowed fractional regression (default .2)")
+    return parser
+
+def main(args=sys.argv[1:]):
+    opts, _ = _parser().parse_args(args)
+    logging.basicConfig(level=logging.WARN)
+    latency = opts.latency/1000. if opts.latency else None
+    bandwidth = int(opts.bandwidth*MB) if opts.bandwidth else None
+    baselines = load_baselines(opts.baseline)
+    failed = False
+    for workload in opts.workload or sorted(WORKLOADS):
+        for target in opts.target or ['ftp', 'dav']:
+            key = scenario_key(workload, target, opts.latency,
+                               opts.bandwidth, opts.scale)
+            result = run_isolated(workload, target, latency, bandwidth,
+                                  opts.scale, opts.timeout)
+            print(key)
+            for metric in sorted(result):
+                print("    %-20s %12.4f" % (metric, result[metric]))
+            if key in baselines:
+                regressions = compare(result, baselines[key], opts.tolerance)
+                for metric, old, new in regressions:
+                    print("    REGRESSION %s: %.4f -> %.4f" % (metric, old, new))
+                failed = failed or bool(regressions)
+            else:
+                print("    (no baseline)")
+            if opts.save_baseline:
+                baselines[key] = result
+    if opts.save_baseline:
+        save_baselines(opts.baseline, baselines)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+"""
+Local FTP, SFTP and WebDAV stand-ins for the benchmarks.
+
+Each server runs in its own process so it doesn't skew the CPU and memory
+figures of the relayer being measured. Every file which is completely
+received is reported as a ``(filename, size, timestamp)`` tuple through a
+``multiprocessing.Queue``.
+"""
+import os
+import time
+import logging
+import multiprocessing
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+class Throttle(object):
+    """
+    Sleeps as needed to keep the observed transfer rate under ``rate``
+    bytes/sec. A ``rate`` of ``None`` disables throttling.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.time()
+        self.nbytes = 0
+
+    def __call__(self, nbytes):
+        if not self.rate:
+            return
+        self.nbytes += nbytes
+        delay = self.nbytes/float(self.rate) - (time.time()-self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _serve_ftp(root, port_queue, received, latency, bandwidth):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, DTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    # Not pyftpdlib's ThrottledDTPHandler, which lets the first second of
+    # each transfer through at full speed
+    class ThrottledDTPHandler(DTPHandler):
+        def __init__(self, sock, cmd_channel):
+            self.throttle = Throttle(bandwidth)
+            DTPHandler.__init__(self, sock, cmd_channel)
+
+        def recv(self, buffer_size):
+            data = DTPHandler.recv(self, buffer_size)
+            self.throttle(len(data))
+            return data
+
+    class Handler(FTPHandler):
+        dtp_handler = ThrottledDTPHandler if bandwidth else DTPHandler
+
+        def pre_process_command(self, line, cmd, arg):
+            if latency:
+                time.sleep(latency)
+            return FTPHandler.pre_process_command(self, line, cmd, arg)
+
+        def on_file_received(self, path):
+            received.put((os.path.basename(path), os.path.getsize(path),
+                          time.time()))
+            os.remove(path)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USERNAME, PASSWORD, root, perm='elradfmwMT')
+    Handler.authorizer = authorizer
+    logging.basicConfig(level=logging.ERROR)
+    server = ThreadedFTPServer(('127.0.0.1', 0), Handler)
+    port_queue.put(server.address[1])
+    server.serve_forever()
+
+
+def _serve_sftp(root, port_queue, received, latency, bandwidth):
+    import socket
+    import threading
+    import paramiko
+    from paramiko.sftp import SFTP_OK
+
+    def delay():
+        if latency:
+            time.sleep(latency)
+
+    class Handle(paramiko.SFTPHandle):
+        def __init__(self, path, f):
+            paramiko.SFTPHandle.__init__(self)
+            self.path = path
+            self.writefile = f
+            self.throttle = Throttle(bandwidth)
+
+        def write(self, offset, data):
+            self.throttle(len(data))
+            return paramiko.SFTPHandle.write(self, offset, data)
+
+        def close(self):
+            paramiko.SFTPHandle.close(self)
+            received.put((os.path.basename(self.path),
+                          os.path.getsize(self.path), time.time()))
+
+    class SFTPServer(paramiko.SFTPServerInterface):
+        def _local(self, path):
+            return os.path.join(root, path.lstrip('/'))
+
+        def _attributes(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def open(self, path, flags, attr):
+            delay()
+            path = self._local(path)
+            fd = os.open(path, flags, 0o644)
+            return Handle(path, os.fdopen(fd, 'wb'))
+
+        def stat(self, path):
+            delay()
+            return self._attributes(self._local(path))
+        lstat = stat
+
+        def mkdir(self, path, attr):
+            delay()
+            os.mkdir(self._local(path))
+            return SFTP_OK
+
+        def remove(self, path):
+            delay()
+            os.remove(self._local(path))
+            return SFTP_OK
+
+        def rename(self, oldpath, newpath):
+            delay()
+            os.rename(self._local(oldpath), self._local(newpath))
+            return SFTP_OK
+        posix_rename = rename
+
+    class Server(paramiko.ServerInterface):
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_auth_password(self, username, password):
+            if (username, password) == (USERNAME, PASSWORD):
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def handle(conn, host_key):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                        SFTPServer)
+        transport.start_server(server=Server())
+
+    logging.basicConfig(level=logging.ERROR)
+    host_key = paramiko.RSAKey.generate(2048)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(100)
+    port_queue.put(sock.getsockname()[1])
+    while True:
+        conn, _ = sock.accept()
+        t = threading.Thread(target=handle, args=(conn, host_key))
+        t.daemon = True
+        t.start()
+
+
+class _ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def make_dav_app(received, latency=None, bandwidth=None, chunk_size=65536):
+    """
+    Returns a WSGI application which accepts (and discards) WebDAV ``PUT``
+    requests.
+    """
+    def app(environ, start_response):
+        method = environ['REQUEST_METHOD']
+        if latency:
+            time.sleep(latency)
+        if method == 'PUT':
+            remaining = int(environ.get('CONTENT_LENGTH') or 0)
+            size = remaining
+            throttle = Throttle(bandwidth)
+            stream = environ['wsgi.input']
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                throttle(len(chunk))
+            name = environ['PATH_INFO'].rstrip('/').rsplit('/', 1)[-1]
+            received.put((name, size, time.time()))
+            start_response('201 Created', [('Content-Length', '0')])
+        elif method == 'MKCOL':
+            start_response('201 Created', [('Content-Length', '0')])
+        else:
+            start_response('405 Method Not Allowed',
+                           [('Content-Length', '0')])
+        return []
+    return app
+
+def _serve_dav(root, port_queue, received, latency, bandwidth):
+    app = make_dav_app(received, latency, bandwidth)
+    server = make_server('127.0.0.1', 0, app,
+                         server_class=_ThreadedWSGIServer,
+                         handler_class=_QuietHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+_servers = {
+    'ftp': _serve_ftp,
+    'dav': _serve_dav,
+    'sftp': _serve_sftp,
+}
+
+class StandInServer(object):
+    """
+    Runs one of the stand-in servers in a child process.
+
+        >>> server = StandInServer('ftp', '/tmp/ftproot')  # doctest: +SKIP
+        >>> server.start()                                  # doctest: +SKIP
+        >>> server.port                                     # doctest: +SKIP
+        40213
+    """
+    def __init__(self, kind, root, latency=None, bandwidth=None):
+        self.kind = kind
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.received = multiprocessing.Queue()
+        self.port = None
+        self._process = None
+
+    def start(self, timeout=10):
+        port_queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_servers[self.kind],
+            args=(self.root, port_queue, self.received, self.latency,
+                  self.bandwidth))
+        self._process.daemon = True
+        self._process.start()
+        self.port = port_queue.get(True, timeout)
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
@@ -0,0 +1,81 @@
+"""
+Measures how long ``ftprelayer`` takes from process start until all the
+watches of a configuration with many relayers are armed.
+
+    python -m benchmarks.startup --relayers 500
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+from .relay import percentile
+
+_CHILD = """
+import sys, time
+t0 = time.time()
+from ftprelayer import Application
+t1 = time.time()
+app = Application.from_config(sys.argv[1])
+app.start()
+t2 = time.time()
+app.stop()
+sys.stdout.write('%r %r %r\\n' % (t0, t1, t2))
+"""
+
+def write_config(path, dirs):
+    lines = ['[logging]', 'level = WARN', '[relayers]']
+    for i, dir in enumerate(dirs):
+        lines += ['    [[relayer%d]]' % i,
+                  '    paths = %s/*.dat, %s/*.txt' % (dir, dir),
+                  '        [[[uploader]]]',
+                  '        use = %s' % ('ftp', 'dav')[i % 2],
+                  '        host = example.com',
+                  '        username = user%d' % i,
+                  '        password = secret']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def measure(config):
+    """
+    Returns ``(interpreter, import, armed)``: seconds from launching the
+    process until the interpreter ran the first statement, until ftprelayer
+    was imported and until all watches were armed.
+    """
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', _CHILD, config])
+    t0, t1, t2 = [float(x) for x in out.split()]
+    return t0 - start, t1 - start, t2 - start
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--relayers', type='int', default=200,
+                      help="Number of relayers, each with its own directory")
+    parser.add_option('--runs', type='int', default=10,
+                      help="Number of times to start the process")
+    opts, _ = parser.parse_args(args)
+    workdir = tempfile.mkdtemp(prefix='ftprelayer-bench-')
+    try:
+        dirs = [os.path.join(workdir, 'in%d' % i)
+                for i in range(opts.relayers)]
+        for dir in dirs:
+            os.makedirs(dir)
+        config = os.path.join(workdir, 'config.ini')
+        write_config(config, dirs)
+        samples = [measure(config) for _ in range(opts.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print("%d relayers, %d runs (median/p90 in ms)" % (opts.relayers,
+                                                        opts.runs))
+    for i, label in enumerate(['interpreter ready', 'ftprelayer imported',
+                               'all watches armed']):
+        values = [s[i]*1000 for s in samples]
+        print("    %-20s %8.1f %8.1f" % (label, percentile(values, 50),
+                                         percentile(values, 90)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+File-arrival workloads.
+
+A workload is a list of bursts, each one a ``(count, size, pause)`` tuple:
+``count`` files of ``size`` bytes are written back-to-back and then the
+generator sleeps ``pause`` seconds before the next burst.
+"""
+import os
+import time
+import multiprocessing
+
+KB = 1024
+MB = 1024*KB
+
+WORKLOADS = {
+    'small': [(500, 4*KB, 0)],
+    'huge': [(3, 64*MB, 0)],
+    'bursty': [(50, 16*KB, .5), (2, 8*MB, .5)]*5,
+}
+
+_block = os.urandom(MB)
+
+def scaled(bursts, scale=1.0):
+    """
+    Scales the file count of every burst, keeping at least one file in each.
+
+        >>> scaled([(10, 5, 0), (1, 7, 1)], .5)
+        [(5, 5, 0), (1, 7, 1)]
+    """
+    return [(max(1, int(count*scale)), size, pause)
+            for count, size, pause in bursts]
+
+def total_files(bursts):
+    return sum(count for count, _, _ in bursts)
+
+def total_bytes(bursts):
+    return sum(count*size for count, size, _ in bursts)
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            chunk = _block[:min(size, len(_block))]
+            f.write(chunk)
+            size -= len(chunk)
+
+def generate(bursts, dir, arrivals):
+    """
+    Writes the files of a workload into ``dir`` putting a
+    ``(filename, size, timestamp)`` tuple into the ``arrivals`` queue as soon
+    as each one is closed.
+    """
+    serial = 0
+    for count, size, pause in bursts:
+        for _ in range(count):
+            name = 'bench-%06d.dat' % serial
+            serial += 1
+            write_file(os.path.join(dir, name), size)
+            arrivals.put((name, size, time.time()))
+        if pause:
+            time.sleep(pause)
+
+class Generator(object):
+    """
+    Runs :func:`generate` in a child process so writing the files is not
+    accounted to the relayer.
+    """
+    def __init__(self, bursts, dir):
+        self.bursts = bursts
+        self.dir = dir
+        self.arrivals = multiprocessing.Queue()
+        self._process = None
+
+    def start(self):
+        self._process = multiprocessing.Process(
+            target=generate, args=(self.bursts, self.dir, self.arrivals))
+        self._process.daemon = True
+        self._process.start()
+
+    def join(self):
+        if self._process is not None:
+            self._process.join()
+            self._process = None
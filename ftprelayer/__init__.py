@@ -4,7 +4,12 @@ import datetime
 import os
 import logging
 import shutil
-from threading import Thread, Event
+import signal
+import mmap
+import zlib
+import hashlib
+import tempfile
+from threading import Thread, Event, Lock
 from fnmatch import fnmatchcase
 import zipfile
 from logging import Formatter
@@ -16,14 +21,11 @@ except ImportError:
     import Queue as queue
     from cStringIO import StringIO as BytesIO
 
-import validate
-from configobj import ConfigObj
-from ftputil import FTPHost
-from pkg_resources import resource_filename
 import pyinotify
-import davclient
 
-from .util import import_string
+from .util import import_string, lazy_import, FileChunks, ChunkReader
+from .claims import ClaimStore
+from .index import ArchiveIndex
 
 
 log = logging.getLogger(__name__)
@@ -33,33 +35,58 @@ SYSLOG_FORMAT = "%(name)s [%(process)d]: %(levelname)-5.5s %(message)s"
 
 class Application(object):
     _watch_mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
-    configspec_filename = resource_filename(__name__, 'configspec.ini')
+    configspec_filename = os.path.join(os.path.dirname(__file__),
+                                       'configspec.ini')
     error_subdir = 'failed'
+    claim_retry_delay = 1
 
     now = datetime.datetime.now # To mock in tests
 
-    def __init__(self, archive_dir=None):
+    def __init__(self, archive_dir=None, claim_dir=None, node_name=None,
+                 claim_lease=60, archive_index=None):
         self._relayers = []
         self._processors = {}
+        self._watches = {}
+        self._configfile = None
+        self._main_config = None
+        self._relayer_configs = {}
+        self._reload_requested = Event()
         self._wm = pyinotify.WatchManager()
         self._notifier = pyinotify.ThreadedNotifier(self._wm)
         self._queue_processor = Thread(target=self._process_queue)
         self._queue = queue.Queue()
         self._stopping = Event()
         self._archive_dir = archive_dir
+        self._index = None
+        if archive_index is not None:
+            self._index = ArchiveIndex(archive_index)
+        self._claims = None
+        if claim_dir is not None:
+            self._claims = ClaimStore(claim_dir, node_name, claim_lease)
+            self._lease_keeper = Thread(target=self._keep_leases)
+            self._lease_keeper.daemon = True
 
     @classmethod
     def from_config(cls, configfile):
-        spec = ConfigObj(cls.configspec_filename, list_values=False,
-                         _inspec=True)
-        config = ConfigObj(configfile, configspec=spec)
-        if config.validate(validate.Validator()) is not True:
-            raise AssertionError("Config is not valid")
+        config = cls._load_config(configfile)
         cls._setup_logging(config['logging'])
         self = cls(**dict(config['main']))
+        self._configfile = configfile
+        self._main_config = dict(config['main'])
         for r in self._relayers_from_config(config['relayers']):
             self.add_relayer(r)
         return self
+
+    @classmethod
+    def _load_config(cls, configfile):
+        import validate
+        from configobj import ConfigObj
+        spec = ConfigObj(cls.configspec_filename, list_values=False,
+                         _inspec=True)
+        config = ConfigObj(configfile, configspec=spec)
+        if config.validate(validate.Validator()) is not True:
+            raise AssertionError("Config is not valid")
+        return config
     
     @classmethod
     def _setup_logging(cls, config):
@@ -81,37 +108,156 @@ class Application(object):
 
     def _relayers_from_config(self, section):
         for name in section.sections:
+            # Keep the section itself, it is only turned into a dict for
+            # comparison when reloading
+            self._relayer_configs[name] = section[name]
             yield Relayer.from_config(name, section[name])
 
+    def reload(self, configfile=None):
+        """
+        Re-reads the configuration and adds, removes or replaces the relayers
+        which changed. Unchanged relayers are kept as they are and files
+        which are already queued are processed with the relayer they were
+        queued for.
+
+        Returns False and keeps the current configuration if the new one
+        cannot be loaded.
+        """
+        configfile = configfile or self._configfile
+        old = dict((r.name, r) for r in self._relayers)
+        try:
+            config = self._load_config(configfile)
+            section = config['relayers']
+            # Build every relayer before touching the running ones so a
+            # relayer which cannot be built doesn't leave the config half
+            # applied
+            changed = []
+            for name in section.sections:
+                new_config = section[name].dict()
+                old_config = self._relayer_configs.get(name)
+                if old_config is not None:
+                    old_config = old_config.dict()
+                if name in old and new_config == old_config:
+                    continue
+                relayer = Relayer.from_config(name, section[name])
+                if name in old and \
+                   new_config['uploader'] == old_config['uploader']:
+                    # Keep the uploader (and whatever connections it holds)
+                    # if its destination did not change
+                    relayer.uploader = old[name].uploader
+                changed.append(relayer)
+        except Exception as e:
+            log.exception("Could not reload %r, keeping current config: %r",
+                          configfile, e)
+            return False
+        if dict(config['main']) != self._main_config:
+            log.warning("Changes to the [main] section need a restart")
+        for name in old:
+            if name not in section.sections:
+                log.info("Removing relayer '%s'", name)
+                self.remove_relayer(old[name])
+                self._relayer_configs.pop(name, None)
+        for relayer in changed:
+            if relayer.name in old:
+                log.info("Replacing relayer '%s'", relayer.name)
+                self.replace_relayer(old[relayer.name], relayer)
+            else:
+                log.info("Adding relayer '%s'", relayer.name)
+                self.add_relayer(relayer)
+            self._relayer_configs[relayer.name] = section[relayer.name]
+        self._close_unused_connections()
+        return True
+
+    def _close_unused_connections(self):
+        # Eg: those of SFTP uploaders whose host or password changed
+        SCPUploader.close(keep=set(
+            u._pool_key for r in self._relayers
+                        for u in uploaders_of(r.uploader)
+                        if isinstance(u, SCPUploader)))
+
+    def request_reload(self):
+        """
+        Asks the thread blocked in start() to reload the configuration.
+        Safe to call from a signal handler.
+        """
+        self._reload_requested.set()
+
     def start(self, block=False):
         self._notifier.start()
         self._queue_processor.start()
+        if self._claims is not None:
+            self._lease_keeper.start()
+        log.info("Watching %d directories", len(self._watches))
         if block:
             while True:
                 self._stopping.wait(1)
+                if self._reload_requested.isSet():
+                    self._reload_requested.clear()
+                    try:
+                        self.reload()
+                    except Exception as e:
+                        log.exception("When reloading: %r", e)
 
 
     def stop(self):
         self._stopping.set()
         self._notifier.stop()
         self._queue_processor.join()
+        if self._index is not None:
+            self._index.flush()
+        SCPUploader.close()
         
     def add_relayer(self, relayer):
         self._relayers.append(relayer)
         for p in relayer.paths:
             self._add_watch(relayer, p)
 
+    def remove_relayer(self, relayer):
+        self._relayers.remove(relayer)
+        for p in relayer.paths:
+            self._remove_watch(relayer, p)
+
+    def replace_relayer(self, old, new):
+        """
+        Puts `new` in place of `old`. The directories both watch stay
+        watched all along so no file is missed meanwhile.
+        """
+        self._relayers[self._relayers.index(old)] = new
+        old_dirs = set(os.path.dirname(p) for p in old.paths)
+        new_dirs = set(os.path.dirname(p) for p in new.paths)
+        for p in new.paths:
+            if os.path.dirname(p) not in old_dirs:
+                self._add_watch(new, p)
+        for dir in old_dirs & new_dirs:
+            self._processors[dir].replace_relayer(old, new)
+        for p in old.paths:
+            if os.path.dirname(p) not in new_dirs:
+                self._remove_watch(old, p)
+
     def _add_watch(self, relayer, path):
         dir = os.path.dirname(path)
         processor = self._get_or_make_processor(dir)
         processor.add_relayer(relayer)
 
+    def _remove_watch(self, relayer, path):
+        dir = os.path.dirname(path)
+        processor = self._processors.get(dir)
+        if processor is None:
+            return
+        processor.remove_relayer(relayer)
+        if not processor.relayers:
+            del self._processors[dir]
+            wd = self._watches.pop(dir, None)
+            if wd is not None and wd >= 0:
+                self._wm.rm_watch(wd)
+
     def _get_or_make_processor(self, dir):
         processor = self._processors.get(dir)
         if processor is None:
             processor = self._processors[dir] = _EventProcessor(self._queue)
-            self._wm.add_watch(dir, self._watch_mask,
-                               proc_fun=processor)
+            wdd = self._wm.add_watch(dir, self._watch_mask,
+                                     proc_fun=processor)
+            self._watches[dir] = wdd.get(dir)
         return processor
 
     def _process_queue(self):
@@ -121,17 +267,61 @@ class Application(object):
             except queue.Empty:
                 pass
             else:
+                if self._claims is None:
+                    self._process(relayer, path)
+                    continue
                 try:
-                    relayer.process(path)
-                    self._archive(relayer, path)
+                    claim = self._claims.acquire(relayer, path)
                 except Exception as e:
+                    # Eg: the shared claim_dir is momentarily unavailable
+                    log.exception("Could not claim %r, %r, will retry: %r",
+                                  relayer.name, path, e)
+                    self._stopping.wait(self.claim_retry_delay)
+                    self._queue.put((relayer, path))
+                    continue
+                if claim is None:
+                    log.debug("Skipping %r, %r: claimed by another node",
+                              relayer.name, path)
+                    continue
+                try:
+                    self._process(relayer, path)
+                finally:
                     try:
-                        log.exception("When processing %r, %r, %r", relayer.name, path, e)
-                        self._archive(relayer, path, has_error=True)
-                    except:
-                        pass
+                        self._claims.release(claim)
+                    except Exception as e:
+                        # The claim expires and is swept if the file is still
+                        # there
+                        log.exception("Could not release claim %r: %r",
+                                      claim, e)
 
-    def _archive(self, relayer, path, has_error=False):
+    def _process(self, relayer, path):
+        try:
+            outcomes = relayer.process(path)
+            self._archive(relayer, path, outcomes=outcomes)
+        except Exception as e:
+            try:
+                log.exception("When processing %r, %r, %r", relayer.name, path, e)
+                outcomes = dict((d, repr(e))
+                                for d in destinations_of(relayer.uploader))
+                self._archive(relayer, path, has_error=True,
+                              outcomes=outcomes)
+            except:
+                pass
+
+    def _keep_leases(self):
+        while not self._stopping.isSet():
+            self._stopping.wait(self._claims.lease/3.)
+            try:
+                self._claims.renew()
+                relayers = dict((r.name, r) for r in self._relayers)
+                for name, path in self._claims.sweep():
+                    relayer = relayers.get(name)
+                    if relayer is not None and relayer.path_matches(path):
+                        self._queue.put((relayer, path))
+            except Exception as e:
+                log.exception("When keeping claims: %r", e)
+
+    def _archive(self, relayer, path, has_error=False, outcomes=None):
         if self._archive_dir is None:
             return
         dest = self._archive_path(relayer, path, has_error=has_error)
@@ -140,6 +330,12 @@ class Application(object):
             os.makedirs(destdir)
         log.info("Archiving %s -> %s", path, dest)
         shutil.move(path, dest)
+        if self._index is not None:
+            try:
+                self._index.add(relayer.name, path, dest, self.now(),
+                                failed=has_error, outcomes=outcomes)
+            except Exception as e:
+                log.exception("When indexing %r: %r", dest, e)
 
     _serial_re = re.compile(r'^(.*?)\.(\d+)$')
     def _archive_path(self, relayer, path, no_clobber=True, has_error=False):
@@ -175,8 +371,17 @@ class _EventProcessor(pyinotify.ProcessEvent):
     process_IN_CLOSE_WRITE = _process
     process_IN_MOVED_TO = _process
 
+    # The notifier thread iterates over self.relayers so it is replaced
+    # instead of modified in place
+
     def add_relayer(self, relayer):
-        self.relayers.append(relayer)
+        self.relayers = self.relayers + [relayer]
+
+    def remove_relayer(self, relayer):
+        self.relayers = [r for r in self.relayers if r is not relayer]
+
+    def replace_relayer(self, old, new):
+        self.relayers = [new if r is old else r for r in self.relayers]
 
 
 class Relayer(object):
@@ -199,9 +404,25 @@ class Relayer(object):
 
     @classmethod
     def _make_processor(cls, section):
+        if section['use'] == 'pipeline':
+            return Pipeline([cls._make_stage(section[name])
+                             for name in sorted(section.sections)])
         cls_or_func = import_string(section['use'])
-        if section.extra_values:
-            args = dict((k, section[k]) for k in section.extra_values)
+        args = dict((k, section[k]) for k in section.extra_values)
+        return cls._instantiate(cls_or_func, args)
+
+    @classmethod
+    def _make_stage(cls, section):
+        # Pipeline stages are not in the configspec so they are not validated
+        cls_or_func = import_string(section['use'])
+        args = dict((k, section[k]) for k in section.scalars if k != 'use')
+        return cls._instantiate(cls_or_func, args)
+
+    @staticmethod
+    def _instantiate(cls_or_func, args):
+        # Classes are instantiated even without arguments (eg: to use their
+        # defaults), plain functions are the processor themselves
+        if args or isinstance(cls_or_func, type):
             return cls_or_func(**args)
         else:
             return cls_or_func
@@ -214,32 +435,116 @@ class Relayer(object):
         base = os.path.commonprefix(self.paths+[path])
         return os.path.relpath(path, base)
         
-    def process(self, path):
+    def process(self, path, name=None):
+        """
+        Relays the file at `path` as `name`, which defaults to its basename.
+        Returns a dict which maps every destination to None if the upload
+        succeeded or to the error if it failed.
+        """
         log.info("Relayer '%s' processing '%s'", self.name, path)
+        name = name or os.path.basename(path)
+        outcomes = {}
         if self.processor is not None:
-            self._process_with_processor(path)
+            self._process_with_processor(path, name, outcomes)
         else:
-            self._process_without_processor(path)
+            self._process_without_processor(path, name, outcomes)
+        return outcomes
                     
-    def _process_with_processor(self, path):
-        for filename, data in self.processor(path):
-            self.uploader.upload(filename, data)
+    def _process_with_processor(self, path, name, outcomes):
+        source = [(name, FileChunks(path))]
+        uploader = self.uploader
+        for filename, chunks in as_stage(self.processor)(source):
+            result = self._upload_chunks(uploader, filename, chunks)
+            self._record(outcomes, result, uploader)
+            failed = set(d for d, e in outcomes.items() if e is not None)
+            if failed:
+                # Don't relay what follows (eg: a checksum of this file) to
+                # where this file could not be relayed
+                remaining = set(destinations_of(self.uploader)) - failed
+                uploader = restrict(self.uploader, remaining)
+                if uploader is None:
+                    break
+
+    def _upload_chunks(self, uploader, filename, chunks):
+        if isinstance(chunks, list) or \
+           not hasattr(uploader, 'upload_fileobj'):
+            # Already in memory (eg: yielded by a processor which returns
+            # bytes) or a third-party uploader which doesn't derive from
+            # Uploader
+            return uploader.upload(filename, ''.join(chunks))
+        chunks = iter(chunks)
+        result = uploader.upload_fileobj(filename, ChunkReader(chunks))
+        # The uploader may have stopped reading (eg: after an error) but the
+        # stages may need the rest (eg: to checksum it)
+        for _ in chunks:
+            pass
+        return result
                    
-    def _process_without_processor(self, path):
-        with open(path) as f:
-            self.uploader.upload(os.path.basename(path), f.read())
+    def _process_without_processor(self, path, filename, outcomes):
+        if hasattr(self.uploader, 'upload_file'):
+            result = self.uploader.upload_file(filename, path)
+        else:
+            # Third-party uploader which doesn't derive from Uploader
+            with open(path, 'rb') as f:
+                result = self.uploader.upload(filename, f.read())
+        self._record(outcomes, result)
+
+    def _record(self, outcomes, result, uploader=None):
+        if result is None:
+            # Uploaders which don't report outcomes per destination either
+            # succeed or raise
+            result = [(destination_of(uploader or self.uploader), None)]
+        for destination, error in result:
+            if outcomes.get(destination) is None:
+                outcomes[destination] = error
                    
         
 
         
+def destination_of(uploader):
+    return getattr(uploader, 'destination', None) or type(uploader).__name__
+
+def uploaders_of(uploader):
+    """
+    Returns the uploaders which actually upload, looking into composites.
+    """
+    if isinstance(uploader, CompositeUploader):
+        return sum([uploaders_of(u) for u in uploader.uploaders], [])
+    if isinstance(uploader, _NullUploader):
+        return []
+    return [uploader]
+
+def destinations_of(uploader):
+    return [destination_of(u) for u in uploaders_of(uploader)]
+
+def restrict(uploader, destinations):
+    """
+    Returns an uploader which only uploads to `destinations` or None if
+    `uploader` doesn't upload to any of them. None `destinations` means all.
+    """
+    if destinations is None:
+        return uploader
+    if isinstance(uploader, CompositeUploader):
+        uploaders = [restrict(u, destinations) for u in uploader.uploaders]
+        uploaders = [u for u in uploaders if u is not None]
+        return CompositeUploader(uploaders) if uploaders else None
+    if destination_of(uploader) in destinations:
+        return uploader
+    return None
+
+
 class Uploader(object):
     __uploaders__ = {}
+    scheme = None
+    destination = None # Identifies where files go in the archive index
 
     def __init__(self, host, username, password=None, dir='/'):
         self.host = host
         self.username = username
         self.password = password
         self.dir = dir
+        self.destination = '%s://%s@%s%s' % (
+            self.scheme or type(self).__name__.lower(), username, host, dir)
 
     @classmethod
     def register(cls, key):
@@ -262,10 +567,31 @@ class Uploader(object):
     def upload(self, filename, data):
         raise NotImplementedError("Abstract method must be overriden")
 
+    def upload_file(self, filename, path):
+        """
+        Uploads the contents of the local file at `path` as `filename`.
+        Subclasses may override it to avoid reading the whole file in memory.
+        """
+        with open(path, 'rb') as f:
+            return self.upload_fileobj(filename, f)
+
+    def upload_fileobj(self, filename, fileobj):
+        """
+        Uploads what is read from `fileobj` as `filename`. Subclasses may
+        override it to upload while reading.
+        """
+        return self.upload(filename, fileobj.read())
+
 @Uploader.register(None)
 class _NullUploader(object):
     def upload(self, filename, data):
-        pass
+        return []
+
+    def upload_file(self, filename, path):
+        return []
+
+    def upload_fileobj(self, filename, fileobj):
+        return []
 
     @classmethod
     def from_config(cls, section):
@@ -273,6 +599,8 @@ class _NullUploader(object):
 
 @Uploader.register('composite')
 class CompositeUploader(Uploader):
+    spool_size = 4*1024*1024
+
     @classmethod
     def from_config(cls, section):
         build = Uploader.from_config
@@ -283,16 +611,58 @@ class CompositeUploader(Uploader):
         self.uploaders = uploaders
 
     def upload(self, filename, data):
+        return self._upload_each('upload', filename, data)
+
+    def upload_file(self, filename, path):
+        return self._upload_each('upload_file', filename, path)
+
+    def upload_fileobj(self, filename, fileobj):
+        if len(self.uploaders) < 2:
+            return self._upload_each('upload_fileobj', filename, fileobj)
+        # A stream can only be read once so keep a copy to rewind for each
+        # uploader. Only small files stay in memory.
+        with tempfile.SpooledTemporaryFile(self.spool_size) as spool:
+            shutil.copyfileobj(fileobj, spool)
+            return self._upload_each('upload_fileobj', filename, spool)
+
+    def _upload_each(self, method, filename, arg):
+        """
+        Calls `method` on every uploader even if some fail and returns a list
+        of ``(destination, error)`` where error is None on success.
+        """
+        outcomes = []
         for uploader in self.uploaders:
+            if hasattr(arg, 'seek'):
+                arg.seek(0)
             try:
-                uploader.upload(filename, data)
-            except:
+                result = self._upload_one(uploader, method, filename, arg)
+            except Exception as e:
                 log.exception("executing %r, %r", uploader, filename)
+                outcomes.append((destination_of(uploader), repr(e)))
+            else:
+                if result is None:
+                    result = [(destination_of(uploader), None)]
+                outcomes.extend(result)
+        return outcomes
+
+
+    @staticmethod
+    def _upload_one(uploader, method, filename, arg):
+        if hasattr(uploader, method):
+            return getattr(uploader, method)(filename, arg)
+        # Third-party uploader which doesn't derive from Uploader
+        if method == 'upload_file':
+            with open(arg, 'rb') as f:
+                return uploader.upload(filename, f.read())
+        if method == 'upload_fileobj':
+            return uploader.upload(filename, arg.read())
+        return getattr(uploader, method)(filename, arg)
 
 
 @Uploader.register('ftp')
 class FTPUploader(Uploader):
-    FTPHost = FTPHost  # for mock inyection in tests
+    scheme = 'ftp'
+    FTPHost = lazy_import('ftputil:FTPHost')  # for mock inyection in tests
 
     @classmethod
     def from_config(cls, section):
@@ -300,19 +670,106 @@ class FTPUploader(Uploader):
                    section.get('password'), section.get('dir','/'))
 
     def upload(self, filename, data):
+        self.upload_fileobj(filename, BytesIO(data))
+
+    def upload_fileobj(self, filename, fileobj):
         with self.FTPHost(self.host, self.username, self.password) as ftp:
             dir = self.dir.rstrip('/') + '/'
             ftp.makedirs(dir)
             destname = dir + filename
             dest = ftp.file(destname, 'wb')
             log.info("FTPUploader.upload: %s -> %s", filename, destname)
-            ftp.copyfileobj(BytesIO(data), dest)
+            ftp.copyfileobj(fileobj, dest)
             dest.close()
 
+    def upload_file(self, filename, path):
+        with self.FTPHost(self.host, self.username, self.password) as ftp:
+            dir = self.dir.rstrip('/') + '/'
+            ftp.makedirs(dir)
+            destname = dir + filename
+            log.info("FTPUploader.upload_file: %s -> %s", path, destname)
+            with open(path, 'rb') as f:
+                _stor_file(ftp._session, destname, f)
+
+
+_sendfile = getattr(os, 'sendfile', None)
+
+def _stor_file(session, destname, f, chunk_size=1024*1024):
+    """
+    STOREs the open file `f` as `destname` through a `ftplib.FTP` session
+    writing it straight to the data socket. `os.sendfile` is used when
+    available so the data never reaches user-space, otherwise it is sent in
+    chunks read into a reused buffer. When the data channel is encrypted the
+    file is mmap'ed one chunk at a time.
+
+    Raises IOError if the file shrinks meanwhile so it is not relayed
+    truncated.
+    """
+    size = os.fstat(f.fileno()).st_size
+    # If ssl was never imported the data channel can't be encrypted
+    ssl = sys.modules.get('ssl')
+    session.voidcmd('TYPE I')
+    conn = session.transfercmd('STOR ' + destname)
+    try:
+        tls = ssl is not None and isinstance(conn, ssl.SSLSocket)
+        if tls:
+            _send_mmaped(conn, f, size, chunk_size)
+            conn.unwrap()
+        elif _sendfile is not None:
+            _send_with_sendfile(conn, f, size)
+        else:
+            _send_buffered(conn, f, size, chunk_size)
+    finally:
+        conn.close()
+    session.voidresp()
+
+def _short_transfer(f, sent, size):
+    return IOError("%s: short transfer, %d of %d bytes"
+                   % (getattr(f, 'name', f), sent, size))
+
+def _send_with_sendfile(conn, f, size):
+    offset = 0
+    while offset < size:
+        sent = _sendfile(conn.fileno(), f.fileno(), offset, size - offset)
+        if not sent:
+            raise _short_transfer(f, offset, size)
+        offset += sent
+
+def _send_buffered(conn, f, size, chunk_size):
+    buf = bytearray(min(chunk_size, size))
+    view = memoryview(buf)
+    offset = 0
+    while offset < size:
+        n = f.readinto(view[:min(chunk_size, size - offset)])
+        if not n:
+            raise _short_transfer(f, offset, size)
+        conn.sendall(view[:n])
+        offset += n
+
+def _send_mmaped(conn, f, size, chunk_size):
+    # Map one chunk at a time and check the size before each, touching a
+    # page past the end of a file which was truncated raises SIGBUS
+    granularity = mmap.ALLOCATIONGRANULARITY
+    chunk_size = max(granularity, chunk_size - chunk_size % granularity)
+    for offset in range(0, size, chunk_size):
+        length = min(chunk_size, size - offset)
+        if os.fstat(f.fileno()).st_size < offset + length:
+            raise _short_transfer(f, offset, size)
+        data = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ,
+                         offset=offset)
+        try:
+            conn.sendall(data[:])
+        finally:
+            data.close()
+
 
 @Uploader.register('dav')
 class DAVUploader(Uploader):
-    DAVClient = davclient.DAVClient  # for mock inyection in tests
+    DAVClient = lazy_import('davclient:DAVClient')  # for mock inyection in tests
+
+    def __init__(self, host, username, password=None, dir='/'):
+        super(DAVUploader, self).__init__(host, username, password, dir)
+        self.destination = host
 
     @classmethod
     def from_config(cls, section):
@@ -327,11 +784,285 @@ class DAVUploader(Uploader):
         client.put(destname, data)
         assert 200 <= client.response.status < 300, client.response.reason
 
+    def upload_file(self, filename, path):
+        with open(path, 'rb') as f:
+            self._put_file(filename, f, os.fstat(f.fileno()).st_size)
+
+    def upload_fileobj(self, filename, fileobj):
+        # httplib sends file bodies in blocks but needs their length first
+        with tempfile.SpooledTemporaryFile(CompositeUploader.spool_size) as f:
+            shutil.copyfileobj(fileobj, f)
+            size = f.tell()
+            f.seek(0)
+            self._put_file(filename, f, size)
+
+    def _put_file(self, filename, f, size):
+        client = self.DAVClient(self.host)
+        client.set_basic_auth(self.username, self.password)
+        destname = self.host + filename
+        log.info("DAVUploader.upload: %s -> %s", filename, destname)
+        client.put(destname, body=f, headers={'Content-Length': str(size)})
+        assert 200 <= client.response.status < 300, client.response.reason
+
 
+@Uploader.register('sftp')
 @Uploader.register('scp')
-class SCPUploader(FTPUploader):
+class SCPUploader(Uploader):
+    """
+    Uploads with SFTP. Requires paramiko.
+
+    SSH connections are pooled: every uploader to the same host and account
+    shares one authenticated connection. Each upload takes an idle SFTP
+    channel on it, or opens a new one if all are busy, and gives it back when
+    done. If `atomic` is true files are uploaded with a temporary name and
+    renamed once complete. Pooled connections stay open until close() is
+    called.
+    """
+    scheme = 'sftp'
+    SSHClient = lazy_import('paramiko:SSHClient')  # for mock inyection in tests
+    SFTPClient = lazy_import('paramiko:SFTPClient')  # for mock inyection in tests
+
+    window_size = 16*1024*1024
+    missing_host_key_policies = {
+        'reject': 'paramiko:RejectPolicy',
+        'warn': 'paramiko:WarningPolicy',
+        'auto_add': 'paramiko:AutoAddPolicy',
+    }
+
+    _pool = {}
+    _idle_channels = {}
+    _busy = {} # id(client) -> number of channels in use
+    _pool_lock = Lock()
+
+    def __init__(self, host, username, password=None, dir='/', port=22,
+                 key_filename=None, atomic=False, known_hosts=None,
+                 missing_host_key='reject'):
+        super(SCPUploader, self).__init__(host, username, password, dir)
+        self.port = port
+        self.key_filename = key_filename
+        self.atomic = atomic
+        self.known_hosts = known_hosts
+        self.missing_host_key = missing_host_key
+        self._dirs = set()
+
+    @classmethod
+    def from_config(cls, section):
+        return cls(section['host'], section['username'],
+                   section.get('password'), section.get('dir', '/'),
+                   port=int(section.get('port', 22)),
+                   key_filename=section.get('key_filename'),
+                   atomic='atomic' in section and section.as_bool('atomic'),
+                   known_hosts=section.get('known_hosts'),
+                   missing_host_key=section.get('missing_host_key', 'reject'))
+
     def upload(self, filename, data):
-        raise NotImplementedError("TODO")
+        self._put(filename, BytesIO(data))
+
+    def upload_file(self, filename, path):
+        with open(path, 'rb') as f:
+            self._put(filename, f)
+
+    def upload_fileobj(self, filename, fileobj):
+        self._put(filename, fileobj)
+
+    def _put(self, filename, f):
+        dir = self.dir.rstrip('/') + '/'
+        destname = dir + filename
+        log.info("SCPUploader.upload: %s -> %s", filename, destname)
+        client = self._connect()
+        sftp = None
+        try:
+            sftp = self._open_channel(client)
+            self._makedirs(sftp, dir)
+            if self.atomic:
+                tmpname = dir + '.' + filename + '.part'
+                sftp.putfo(f, tmpname)
+                self._rename(sftp, tmpname, destname)
+            else:
+                sftp.putfo(f, destname)
+        except:
+            if sftp is not None:
+                sftp.close()
+                self._channel_done(client)
+            self._dirs.discard(dir)
+            self._discard_if_dead(client)
+            raise
+        self._release_channel(client, sftp)
+
+    def _makedirs(self, sftp, dir):
+        if dir in self._dirs:
+            return
+        parts = [p for p in dir.split('/') if p]
+        prefix = '/' if dir.startswith('/') else ''
+        for i in range(len(parts)):
+            path = prefix + '/'.join(parts[:i+1])
+            try:
+                sftp.stat(path)
+            except IOError:
+                sftp.mkdir(path)
+        self._dirs.add(dir)
+
+    def _rename(self, sftp, source, target):
+        try:
+            sftp.posix_rename(source, target)
+        except IOError:
+            # Server without the posix-rename extension: plain SFTP rename
+            # fails if the target exists
+            try:
+                sftp.remove(target)
+            except IOError:
+                pass
+            sftp.rename(source, target)
+
+    @property
+    def _pool_key(self):
+        return (self.host, self.port, self.username, self.password,
+                self.key_filename)
+
+    def _connect(self):
+        with self._pool_lock:
+            client = self._pool.get(self._pool_key)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+            log.info("SCPUploader: connecting to %s@%s:%s", self.username,
+                     self.host, self.port)
+            client = self.SSHClient()
+            if self.known_hosts:
+                client.load_host_keys(self.known_hosts)
+            else:
+                client.load_system_host_keys()
+            policy = import_string(
+                self.missing_host_key_policies[self.missing_host_key])
+            client.set_missing_host_key_policy(policy())
+            client.connect(self.host, port=self.port, username=self.username,
+                           password=self.password,
+                           key_filename=self.key_filename,
+                           look_for_keys=(self.key_filename is None and
+                                          self.password is None))
+            self._pool[self._pool_key] = client
+            self._idle_channels.pop(self._pool_key, None)
+            return client
+
+    @classmethod
+    def close(cls, keep=()):
+        """
+        Closes the pooled connections except those with a pool key in `keep`.
+        Connections with uploads in progress are closed when they finish.
+        """
+        to_close = []
+        with cls._pool_lock:
+            for key, client in list(cls._pool.items()):
+                if key in keep:
+                    continue
+                del cls._pool[key]
+                to_close.extend(cls._idle_channels.pop(key, []))
+                if not cls._busy.get(id(client)):
+                    to_close.append(client)
+        for ob in to_close:
+            ob.close()
+
+    def _open_channel(self, client):
+        sftp = None
+        with self._pool_lock:
+            idle = self._idle_channels.get(self._pool_key, [])
+            while idle and sftp is None:
+                sftp = idle.pop()
+                if sftp.get_channel().closed:
+                    sftp = None
+        if sftp is None:
+            sftp = self.SFTPClient.from_transport(client.get_transport(),
+                                                  window_size=self.window_size)
+        with self._pool_lock:
+            self._busy[id(client)] = self._busy.get(id(client), 0) + 1
+        return sftp
+
+    def _release_channel(self, client, sftp):
+        with self._pool_lock:
+            pooled = self._pool.get(self._pool_key) is client
+            if pooled:
+                self._idle_channels.setdefault(self._pool_key, []).append(sftp)
+        if not pooled:
+            # Dropped from the pool meanwhile (eg: by close())
+            sftp.close()
+        self._channel_done(client)
+
+    def _channel_done(self, client):
+        with self._pool_lock:
+            busy = self._busy.pop(id(client), 1) - 1
+            if busy:
+                self._busy[id(client)] = busy
+                return
+            dropped = self._pool.get(self._pool_key) is not client
+        if dropped:
+            client.close()
+
+    def _discard_if_dead(self, client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            with self._pool_lock:
+                if self._pool.get(self._pool_key) is client:
+                    del self._pool[self._pool_key]
+                    self._idle_channels.pop(self._pool_key, None)
+            client.close()
+
+
+def as_stage(processor):
+    """
+    Returns a pipeline stage for `processor`. A stage receives an iterable of
+    ``(filename, chunks)``, where chunks is an iterable of byte strings, and
+    yields ``(filename, chunks)`` lazily so no file has to be kept in memory.
+    Each item's chunks must be consumed before asking for the next item.
+
+    Processors with a ``stream`` method are already stages. Plain processors
+    which receive a path and yield ``(filename, contents)`` are adapted.
+    """
+    stream = getattr(processor, 'stream', None)
+    if stream is not None:
+        return stream
+    return _legacy_stage(processor)
+
+def _legacy_stage(processor):
+    def stage(items):
+        for name, chunks in items:
+            path = getattr(chunks, 'path', None)
+            if path is not None and os.path.basename(path) == name:
+                # The untouched incoming file
+                for new_name, data in processor(path):
+                    yield new_name, [data]
+                continue
+            # Write the stream where the processor can read it, with the
+            # name it expects
+            tmpdir = tempfile.mkdtemp(prefix='ftprelayer-')
+            try:
+                path = os.path.join(tmpdir, os.path.basename(name))
+                with open(path, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                for new_name, data in processor(path):
+                    yield new_name, [data]
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    return stage
+
+
+class Pipeline(object):
+    """
+    Chains several processors, each one receiving what the previous yields.
+    """
+    def __init__(self, processors):
+        self.processors = processors
+
+    def stream(self, items):
+        for processor in self.processors:
+            items = as_stage(processor)(items)
+        return items
+
+    def __call__(self, path):
+        items = [(os.path.basename(path), FileChunks(path))]
+        for name, chunks in self.stream(items):
+            yield name, ''.join(chunks)
 
 
 class add_prefix(object):
@@ -343,6 +1074,10 @@ class add_prefix(object):
         with open(path) as f:
             yield new_name, f.read()
 
+    def stream(self, items):
+        for name, chunks in items:
+            yield self.prefix + name, chunks
+
 class add_prefix_to_zip_contents(object):
     def __init__(self, prefix):
         self.prefix = prefix
@@ -376,14 +1111,72 @@ class add_date_prefix(object):
         with open(path) as f:
             yield self._new_name(path), f.read()
 
+    def stream(self, items):
+        for name, chunks in items:
+            yield self._new_name(name), chunks
+
     def _new_name(self, path):
         return self.now().strftime(self.format) + os.path.basename(path)
 
+class gzip_compress(object):
+    """
+    Compresses every file with gzip while it is relayed and appends ``.gz``
+    to its name.
+    """
+    def __init__(self, level=6):
+        self.level = int(level)
+
+    def stream(self, items):
+        for name, chunks in items:
+            yield name + '.gz', self._compress(chunks)
+
+    def _compress(self, chunks):
+        # wbits > 16 writes a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+class checksum_sidecar(object):
+    """
+    Relays after every file a ``<name>.<algorithm>`` file with its checksum
+    in the format of ``md5sum``, ``sha1sum``, etc.
+    """
+    def __init__(self, algorithm='md5'):
+        hashlib.new(algorithm) # Fail early if it is not supported
+        self.algorithm = algorithm
+
+    def stream(self, items):
+        for name, chunks in items:
+            checksum = hashlib.new(self.algorithm)
+            state = {'complete': False}
+            yield name, self._update(checksum, chunks, state)
+            if not state['complete']:
+                log.warning("Not relaying the checksum of %s, it was not "
+                            "read completely", name)
+                continue
+            yield ('%s.%s' % (name, self.algorithm),
+                   ['%s  %s\n' % (checksum.hexdigest(), name)])
+
+    def _update(self, checksum, chunks, state):
+        for chunk in chunks:
+            checksum.update(chunk)
+            yield chunk
+        state['complete'] = True
+
 def main(args=sys.argv):
     if len(args)<2:
         print>>sys.stderr, "Usage %s <configfile>"%args[0]
+        print>>sys.stderr, "      %s replay [options] <configfile>"%args[0]
         return -1
+    if args[1] == 'replay':
+        from .replay import main as replay_main
+        return replay_main(args[2:])
     app = Application.from_config(args[1])
+    signal.signal(signal.SIGHUP, lambda signum, frame: app.request_reload())
     try:
         log.info("Starting app")
         app.start(True)
@@ -0,0 +1,188 @@
+"""
+Claims on incoming files so several nodes can relay from a shared directory
+without uploading the same file twice.
+
+A claim is a file in a shared directory, named after a hash of the relayer
+name and the identity (path, inode, size and mtime) of the incoming file,
+which is created with ``O_EXCL`` so only one node can own it. Its mtime is
+the lease: the owner renews it periodically and any node may break a claim
+whose lease has expired, which means its owner died while processing it.
+When the owner is done a ``.done`` marker is left behind so the same file
+is not relayed again.
+
+Nodes must have their clocks synchronized since leases are compared against
+the local time.
+"""
+import os
+import time
+import errno
+import socket
+import hashlib
+import logging
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class ClaimStore(object):
+    done_suffix = '.done'
+    stale_suffix = '.stale'
+    done_retention = 24*60*60
+
+    now = time.time # To mock in tests
+
+    def __init__(self, dir, node=None, lease=60):
+        self.dir = dir
+        self.node = node or '%s.%d' % (socket.gethostname(), os.getpid())
+        self.lease = lease
+        self._held = set()
+        self._lock = Lock()
+        try:
+            os.makedirs(dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, relayer, path):
+        st = os.stat(path)
+        ident = '\0'.join([relayer.name, path, str(st.st_ino),
+                           str(st.st_size), repr(st.st_mtime)])
+        return hashlib.sha1(ident).hexdigest()
+
+    def acquire(self, relayer, path):
+        """
+        Tries to claim `path` for `relayer` and returns the claim, which must
+        be passed to release() when done, or None if the file is gone or
+        another node owns it or already relayed it.
+        """
+        try:
+            claim = os.path.join(self.dir, self.key(relayer, path))
+        except OSError:
+            return None
+        if os.path.exists(claim + self.done_suffix):
+            return None
+        if not self._create(claim, relayer, path):
+            if not self._break_if_stale(claim):
+                return None
+            if not self._create(claim, relayer, path):
+                return None
+        if os.path.exists(claim + self.done_suffix):
+            # Another node finished it between our checks
+            _remove(claim)
+            return None
+        with self._lock:
+            self._held.add(claim)
+        return claim
+
+    def release(self, claim):
+        """
+        Marks the claimed file as relayed and gives up the claim.
+        """
+        with self._lock:
+            self._held.discard(claim)
+        with open(claim + self.done_suffix, 'w') as f:
+            f.write(self.node + '\n')
+        _remove(claim)
+
+    def renew(self):
+        """
+        Extends the lease of every claim held by this node.
+        """
+        with self._lock:
+            held = list(self._held)
+        for claim in held:
+            try:
+                os.utime(claim, None)
+            except OSError as e:
+                log.warning("Could not renew claim %s: %r", claim, e)
+
+    def sweep(self):
+        """
+        Breaks the expired claims of other nodes and returns a list of
+        ``(relayer_name, path)`` for those whose file still needs relaying.
+        Also removes old ``.done`` markers.
+        """
+        expired = []
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            try:
+                age = self.now() - os.stat(path).st_mtime
+            except OSError:
+                continue
+            if name.endswith(self.done_suffix):
+                if age > self.done_retention:
+                    _remove(path)
+            elif name.endswith(self.stale_suffix):
+                # Left behind by a node which died while breaking a claim
+                if age > self.lease:
+                    _remove(path)
+            elif age > self.lease:
+                owner = self._read(path)
+                if owner and self._break_if_stale(path):
+                    node, relayer_name, filename = owner
+                    log.warning("Took over claim on %r from node %r",
+                                filename, node)
+                    if os.path.exists(filename):
+                        expired.append((relayer_name, filename))
+        return expired
+
+    def _create(self, claim, relayer, path):
+        try:
+            fd = os.open(claim, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join([self.node, relayer.name, path]) + '\n')
+        return True
+
+    def _read(self, claim):
+        try:
+            with open(claim) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return None
+        if len(lines) != 3:
+            return None
+        return lines
+
+    def _is_stale(self, claim):
+        return self.now() - os.stat(claim).st_mtime > self.lease
+
+    def _break_if_stale(self, claim):
+        """
+        Removes `claim` if its lease expired. Returns True if the claim can
+        be created again.
+        """
+        try:
+            if not self._is_stale(claim):
+                return False
+        except OSError:
+            return True
+        # Only one node can succeed in renaming it away
+        moved = '%s.%s%s' % (claim, self.node, self.stale_suffix)
+        try:
+            os.rename(claim, moved)
+        except OSError:
+            return False
+        try:
+            if self._is_stale(moved):
+                return True
+            # Someone else broke it and claimed it again before we renamed
+            # it, give it back
+            try:
+                os.link(moved, claim)
+            except OSError:
+                pass
+            return False
+        finally:
+            _remove(moved)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,230 @@
+"""
+SQLite index of the archived files so they can be found and relayed again
+without walking the archive.
+"""
+import os
+import hashlib
+import logging
+from threading import Thread, Lock
+try:
+    import queue
+except ImportError:
+    # support python < 3
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    relayer TEXT NOT NULL,
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    sha1 TEXT,
+    archived_at TEXT NOT NULL,
+    failed INTEGER NOT NULL,
+    injected_at TEXT
+);
+CREATE INDEX IF NOT EXISTS files_relayer_archived_at
+    ON files (relayer, archived_at);
+CREATE INDEX IF NOT EXISTS files_archived_at ON files (archived_at);
+CREATE TABLE IF NOT EXISTS outcomes (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    destination TEXT NOT NULL,
+    error TEXT,
+    attempted_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outcomes_file_id ON outcomes (file_id, destination);
+"""
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class ArchivedFile(object):
+    """
+    A row of the index. `failed_destinations` lists the destinations whose
+    last upload attempt failed. `injected_at` is when it was last put back
+    where it arrived to be relayed again, if ever.
+    """
+    def __init__(self, id, relayer, source, path, size, sha1, archived_at,
+                 failed, injected_at=None, failed_destinations=()):
+        self.id = id
+        self.relayer = relayer
+        self.source = source
+        self.path = path
+        self.size = size
+        self.sha1 = sha1
+        self.archived_at = archived_at
+        self.failed = bool(failed)
+        self.injected_at = injected_at
+        self.failed_destinations = list(failed_destinations)
+
+    def __repr__(self):
+        return '<ArchivedFile %r %r>' % (self.relayer, self.path)
+
+
+class ArchiveIndex(object):
+    """
+    The checksums of the archived files are computed in a background thread
+    so indexing doesn't delay relaying the next file.
+    """
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        self._lock = Lock()
+        self._pending = queue.Queue()
+        self._hasher = None
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        # Paths are bytes which may not be ASCII (or even valid in any
+        # encoding), store and return them untouched
+        self._db.text_factory = str
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+            columns = [r[1] for r in
+                       self._db.execute('PRAGMA table_info(files)')]
+            if 'injected_at' not in columns:
+                # Index created by an older version
+                self._db.execute('ALTER TABLE files ADD COLUMN injected_at'
+                                 ' TEXT')
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+    def flush(self):
+        """
+        Waits until the checksums of every added file are stored.
+        """
+        self._pending.join()
+
+    def add(self, relayer, source, path, archived_at, failed=False,
+            outcomes=None):
+        """
+        Records that `source` was archived at `path`. `outcomes` maps each
+        destination to None or to the error of its upload.
+        """
+        size = os.path.getsize(path)
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    'INSERT INTO files (relayer, source, path, size,'
+                    '                   archived_at, failed)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (relayer, source, path, size,
+                     archived_at.strftime(TIME_FORMAT), int(bool(failed))))
+                file_id = cursor.lastrowid
+                self._add_outcomes(file_id, outcomes or {}, archived_at)
+            if self._hasher is None:
+                self._hasher = Thread(target=self._hash_pending)
+                self._hasher.daemon = True
+                self._hasher.start()
+        self._pending.put((file_id, path))
+        return file_id
+
+    def _hash_pending(self):
+        while True:
+            file_id, path = self._pending.get()
+            try:
+                sha1 = _sha1(path)
+                with self._lock:
+                    with self._db:
+                        self._db.execute(
+                            'UPDATE files SET sha1 = ? WHERE id = ?',
+                            (sha1, file_id))
+            except Exception as e:
+                log.exception("When hashing %r: %r", path, e)
+            finally:
+                self._pending.task_done()
+
+    def record_outcomes(self, file_id, outcomes, attempted_at, failed=None):
+        """
+        Records a new upload attempt of an archived file. If `failed` is not
+        None the failed flag of the file is updated too.
+        """
+        with self._lock:
+            with self._db:
+                self._add_outcomes(file_id, outcomes, attempted_at)
+                if failed is not None:
+                    self._db.execute('UPDATE files SET failed = ? WHERE id = ?',
+                                     (int(bool(failed)), file_id))
+
+    def mark_injected(self, file_id, injected_at):
+        """
+        Records that an archived file was put back where it arrived. The
+        relayer will index it again with the new outcomes so it is no longer
+        returned as failed.
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute('UPDATE files SET injected_at = ?'
+                                 ' WHERE id = ?',
+                                 (injected_at.strftime(TIME_FORMAT), file_id))
+
+    def _add_outcomes(self, file_id, outcomes, attempted_at):
+        self._db.executemany(
+            'INSERT INTO outcomes (file_id, destination, error, attempted_at)'
+            ' VALUES (?, ?, ?, ?)',
+            [(file_id, destination, error, attempted_at.strftime(TIME_FORMAT))
+             for destination, error in sorted(outcomes.items())])
+
+    def query(self, relayers=None, since=None, until=None, failed=False,
+              destination=None):
+        """
+        Returns the ArchivedFile matching every given criteria, oldest first:
+        archived by any of `relayers`, at or after `since` and before
+        `until` (datetimes). If `failed` only files which failed as a whole
+        or whose last attempt to some destination (or to `destination`, if
+        given) failed, and which were not injected since, are returned.
+        """
+        # Only the last attempt to each destination counts, which is the
+        # one with the highest id
+        join = ('LEFT JOIN outcomes o ON o.file_id = f.id'
+                ' AND o.error IS NOT NULL'
+                ' AND o.id = (SELECT max(o2.id) FROM outcomes o2'
+                '             WHERE o2.file_id = o.file_id'
+                '               AND o2.destination = o.destination)')
+        where, params = [], []
+        if destination is not None:
+            join += ' AND o.destination = ?'
+            params.append(destination)
+        if failed:
+            where.append('f.injected_at IS NULL')
+        if relayers:
+            where.append('f.relayer IN (%s)' % ', '.join('?'*len(relayers)))
+            params.extend(relayers)
+        if since is not None:
+            where.append('f.archived_at >= ?')
+            params.append(since.strftime(TIME_FORMAT))
+        if until is not None:
+            where.append('f.archived_at < ?')
+            params.append(until.strftime(TIME_FORMAT))
+        sql = ('SELECT f.id, f.relayer, f.source, f.path, f.size, f.sha1,'
+               '       f.archived_at, f.failed, f.injected_at,'
+               "       group_concat(o.destination, '\n')"
+               ' FROM files f ' + join)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' GROUP BY f.id'
+        if failed:
+            sql += ' HAVING f.failed OR count(o.id) > 0'
+        sql += ' ORDER BY f.archived_at, f.id'
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [ArchivedFile(*row[:9], failed_destinations=
+                             sorted(row[9].split('\n')) if row[9] else [])
+                for row in rows]
+
+
+def _sha1(path, chunk_size=1024*1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
@@ -0,0 +1,260 @@
+"""
+``ftprelayer replay``: relays archived files again, selecting them through
+the archive index.
+
+By default the files are uploaded from the archive by this process, which
+records the new outcomes in the index. With ``--inject`` they are copied back
+to where they arrived so a running ``ftprelayer`` relays them, to every
+destination, and indexes them again.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import datetime
+import tempfile
+from threading import Thread
+from optparse import OptionParser
+try:
+    import queue
+except ImportError:
+    # support python < 3
+    import Queue as queue
+
+from . import Application, Relayer, destinations_of, restrict
+
+log = logging.getLogger(__name__)
+
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M',
+                '%Y-%m-%d')
+
+def parse_time(s):
+    """
+        >>> parse_time('2014-03-01')
+        datetime.datetime(2014, 3, 1, 0, 0)
+        >>> parse_time('2014-03-01 10:20')
+        datetime.datetime(2014, 3, 1, 10, 20)
+    """
+    for format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(s, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date %r, use YYYY-MM-DD[ HH:MM[:SS]]" % s)
+
+
+class Replayer(object):
+    """
+    Relays archived files again using up to `concurrency` threads.
+
+    If `only_failed` only the destinations whose last attempt failed are
+    retried, unless the file failed as a whole. If `destination` is given
+    nothing else is uploaded to.
+
+    Injected files which arrived with the same name are injected one at a
+    time, waiting up to `inject_timeout` seconds for the running relayer to
+    archive the previous one.
+    """
+    inject_timeout = 600
+    inject_poll = .5
+
+    def __init__(self, app, index, concurrency=4, only_failed=False,
+                 destination=None, inject=False):
+        if inject and destination is not None:
+            raise ValueError("Injected files are relayed to every "
+                             "destination")
+        self.app = app
+        self.index = index
+        self.concurrency = concurrency
+        self.only_failed = only_failed
+        self.destination = destination
+        self.inject = inject
+        self._relayers = dict((r.name, r) for r in app._relayers)
+
+    def run(self, files):
+        """
+        Returns the number of files which were relayed and which failed.
+        """
+        pending = queue.Queue()
+        groups = self._groups(files)
+        for group in groups:
+            pending.put(group)
+        results = []
+        workers = [Thread(target=self._work, args=(pending, results))
+                   for _ in range(max(1, min(self.concurrency, len(groups))))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        ok = results.count(True)
+        return ok, len(results) - ok
+
+    def _groups(self, files):
+        """
+        Splits `files` in lists which must be replayed in order by the same
+        worker: those injected to the same place.
+        """
+        if not self.inject:
+            return [[f] for f in files]
+        groups, by_source = [], {}
+        for f in files:
+            if f.source not in by_source:
+                by_source[f.source] = []
+                groups.append(by_source[f.source])
+            by_source[f.source].append(f)
+        return groups
+
+    def _work(self, pending, results):
+        while True:
+            try:
+                group = pending.get_nowait()
+            except queue.Empty:
+                return
+            for i, archived in enumerate(group):
+                if i and not self._wait_picked_up(archived.source):
+                    log.error("%s was not relayed in %ss, not injecting %s",
+                              archived.source, self.inject_timeout,
+                              ', '.join(f.path for f in group[i:]))
+                    results.extend([False] * (len(group) - i))
+                    break
+                try:
+                    results.append(self.replay(archived))
+                except Exception as e:
+                    log.exception("When replaying %r: %r", archived, e)
+                    results.append(False)
+
+    def _wait_picked_up(self, path):
+        deadline = time.time() + self.inject_timeout
+        while os.path.exists(path):
+            if time.time() > deadline:
+                return False
+            time.sleep(self.inject_poll)
+        return True
+
+    def replay(self, archived):
+        relayer = self._relayers.get(archived.relayer)
+        if relayer is None:
+            log.error("Relayer '%s' of %s is not configured",
+                      archived.relayer, archived.path)
+            return False
+        if not os.path.exists(archived.path):
+            log.error("%s is no longer in the archive", archived.path)
+            return False
+        if self.inject:
+            return self._inject(archived)
+        destinations = self._destinations(archived)
+        uploader = restrict(relayer.uploader, destinations)
+        if uploader is None:
+            log.info("Nothing to replay for %s", archived.path)
+            return True
+        relayer = Relayer(relayer.name, uploader, relayer.paths,
+                          relayer.processor)
+        try:
+            # The archived file may have a serial suffix (eg: foo.txt.1)
+            outcomes = relayer.process(archived.path,
+                                       os.path.basename(archived.source))
+        except Exception as e:
+            log.exception("When replaying %r: %r", archived, e)
+            outcomes = dict((d, repr(e)) for d in destinations_of(uploader))
+        failed = any(error is not None for error in outcomes.values())
+        # The failed flag can only be cleared if every destination was tried
+        self.index.record_outcomes(archived.id, outcomes, self.app.now(),
+                                   failed=failed if destinations is None
+                                                 else None)
+        return not failed
+
+    def _destinations(self, archived):
+        destinations = None
+        if self.only_failed and not archived.failed:
+            destinations = set(archived.failed_destinations)
+        if self.destination is not None:
+            if destinations is None:
+                destinations = set([self.destination])
+            else:
+                destinations &= set([self.destination])
+        return destinations
+
+    def _inject(self, archived):
+        if self.only_failed and not archived.failed:
+            log.error("Not injecting %s: only %s failed and it would be "
+                      "relayed to every destination, replay it without "
+                      "--inject", archived.path,
+                      ', '.join(archived.failed_destinations))
+            return False
+        if os.path.exists(archived.source):
+            log.error("Not replaying %s: %s already exists", archived.path,
+                      archived.source)
+            return False
+        # Copy it outside of the watched dir first so it appears complete
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(archived.path))
+        os.close(fd)
+        try:
+            shutil.copyfile(archived.path, tmp)
+            log.info("Injecting %s -> %s", archived.path, archived.source)
+            shutil.move(tmp, archived.source)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.index.mark_injected(archived.id, self.app.now())
+        return True
+
+
+def _parser():
+    parser = OptionParser(usage="%prog replay [options] <configfile>",
+                          prog='ftprelayer')
+    parser.add_option('-r', '--relayer', action='append', default=[],
+                      help="Only files of this relayer, may be repeated")
+    parser.add_option('--since', type='string',
+                      help="Only files archived at or after this date")
+    parser.add_option('--until', type='string',
+                      help="Only files archived before this date")
+    parser.add_option('--failed', action='store_true', default=False,
+                      help="Only failed files, and only to the destinations "
+                           "which failed")
+    parser.add_option('--destination',
+                      help="Only upload to this destination")
+    parser.add_option('-j', '--concurrency', type='int', default=4,
+                      help="Number of files relayed at once (default 4)")
+    parser.add_option('--inject', action='store_true', default=False,
+                      help="Copy the files back to where they arrived for "
+                           "a running ftprelayer to relay them to every "
+                           "destination")
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+                      help="Only list the files which would be replayed")
+    return parser
+
+def main(args):
+    parser = _parser()
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage(sys.stderr)
+        return -1
+    try:
+        since = opts.since and parse_time(opts.since)
+        until = opts.until and parse_time(opts.until)
+    except ValueError as e:
+        parser.error(str(e))
+    if opts.inject and opts.destination:
+        parser.error("--inject relays to every destination, it can't be "
+                     "used with --destination")
+    app = Application.from_config(args[0])
+    index = app._index
+    if index is None:
+        sys.stderr.write("archive_index is not configured in %s\n" % args[0])
+        return -1
+    files = index.query(relayers=opts.relayer, since=since or None,
+                        until=until or None, failed=opts.failed,
+                        destination=opts.destination)
+    if opts.dry_run:
+        for f in files:
+            sys.stdout.write('%s %s %s %s\n' % (
+                f.archived_at, f.relayer, f.path,
+                ','.join(f.failed_destinations)))
+        return 0
+    replayer = Replayer(app, index, opts.concurrency, opts.failed,
+                        opts.destination, opts.inject)
+    ok, failed = replayer.run(files)
+    log.info("Replayed %d files, %d failed", ok, failed)
+    sys.stdout.write("Replayed %d files, %d failed\n" % (ok, failed))
+    return 1 if failed else 0
@@ -35,7 +35,7 @@ class TestApplication(TestCase):
 
     def test_all_relayers_are_parsed(self):
         app = self._makeOneFromConfig()
-        self.failUnlessEqual(7, len(app._relayers))
+        self.failUnlessEqual(8, len(app._relayers))
 
     def test_uploaders_are_properly_loaded_and_configured(self):
         from .. import (CompositeUploader, SCPUploader, FTPUploader,
@@ -74,6 +74,16 @@ class TestApplication(TestCase):
         self.assertIsInstance(app._relayers[3].processor, add_prefix)
         self.failUnlessEqual(app._relayers[3].processor.prefix, 'foo')
 
+    def test_processor_pipeline_is_loaded_in_order(self):
+        from .. import Pipeline, add_prefix, gzip_compress, checksum_sidecar
+        app = self._makeOneFromConfig()
+        processor = app._relayers[7].processor
+        self.assertIsInstance(processor, Pipeline)
+        self.failUnlessEqual([add_prefix, gzip_compress, checksum_sidecar],
+                             [type(p) for p in processor.processors])
+        self.failUnlessEqual('foo', processor.processors[0].prefix)
+        self.failUnlessEqual(9, processor.processors[1].level)
+
     def test_watch_new_file_creation(self):
         app = self._makeOne()
         dir = self._makeTempDir()
@@ -139,6 +149,36 @@ class TestApplication(TestCase):
         self.assertIn(os.path.basename(fname), archive_path)
         self.failUnless(os.path.exists(archive_path))
 
+    def test_archived_files_are_indexed(self):
+        from .. import CompositeUploader
+        archive_dir = self._makeTempDir()
+        index = os.path.join(self._makeTempDir(), 'index.sqlite')
+        app = self._makeOne(archive_dir=archive_dir, archive_index=index)
+        dir = self._makeTempDir()
+        class uploader(object):
+            destination = 'ftp://a'
+            def upload_file(self, filename, path):
+                pass
+        class failing_uploader(object):
+            destination = 'ftp://b'
+            def upload_file(self, filename, path):
+                raise RuntimeError
+        relayer = self._makeRelayer(
+            paths=[dir+'/*'],
+            uploader=CompositeUploader([uploader(), failing_uploader()]))
+        app.add_relayer(relayer)
+        self.addCleanup(app.stop)
+        app.start()
+        fname = os.path.join(dir, 'foo.txt')
+        with open(fname, 'w') as f:
+            f.write('foo')
+        time.sleep(.1)
+        files = app._index.query(failed=True)
+        self.failUnlessEqual(1, len(files))
+        self.failUnlessEqual(fname, files[0].source)
+        self.failUnless(os.path.exists(files[0].path))
+        self.failUnlessEqual(['ftp://b'], files[0].failed_destinations)
+
     def test_archive_path_does_not_clobber(self):
         archive_dir = self._makeTempDir()
         app = self._makeOne(archive_dir=archive_dir)
@@ -219,6 +259,194 @@ class TestApplication(TestCase):
         time.sleep(.1)
         self.failUnless(state['called2'])
 
+    def test_shared_dir_is_relayed_by_one_node(self):
+        claim_dir = self._makeTempDir()
+        dir = self._makeTempDir()
+        processed = []
+        for node in ('node1', 'node2'):
+            app = self._makeOne(claim_dir=claim_dir, node_name=node)
+            relayer = self._makeRelayer(paths=[dir+'/*'])
+            relayer.process = lambda path, node=node: processed.append(node)
+            app.add_relayer(relayer)
+            self.addCleanup(app.stop)
+            app.start()
+        with open(os.path.join(dir, 'foo.txt'), 'w') as f:
+            f.write('foo')
+        time.sleep(.2)
+        self.failUnlessEqual(1, len(processed))
+
+    def test_claim_errors_do_not_stop_processing(self):
+        claim_dir = self._makeTempDir()
+        dir = self._makeTempDir()
+        processed = []
+        app = self._makeOne(claim_dir=claim_dir)
+        app.claim_retry_delay = .05
+        relayer = self._makeRelayer(paths=[dir+'/*'])
+        relayer.process = lambda path: processed.append(path)
+        app.add_relayer(relayer)
+        shutil.rmtree(claim_dir)
+        self.addCleanup(app.stop)
+        app.start()
+        path = os.path.join(dir, 'foo.txt')
+        with open(path, 'w') as f:
+            f.write('foo')
+        time.sleep(.2)
+        self.failUnlessEqual([], processed)
+        os.mkdir(claim_dir)
+        time.sleep(.2)
+        self.failUnlessEqual([path], processed)
+
+    def _writeConfig(self, path, relayers):
+        lines = ['[relayers]']
+        for name, paths, host in relayers:
+            lines += ['    [[%s]]' % name,
+                      '    paths = %s,' % ', '.join(paths),
+                      '        [[[uploader]]]',
+                      '        use = ftp',
+                      '        host = %s' % host,
+                      '        username = pepe']
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _makeReloadableApp(self):
+        dir = self._makeTempDir()
+        config = os.path.join(dir, 'config.ini')
+        watched = [self._makeTempDir(), self._makeTempDir()]
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*'], 'example.com'),
+            ('r2', [watched[1]+'/*'], 'example.com'),
+            ])
+        from .. import Application
+        return Application.from_config(config), config, watched
+
+    def test_reload_adds_and_removes_relayers(self):
+        app, config, watched = self._makeReloadableApp()
+        new_dir = self._makeTempDir()
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*'], 'example.com'),
+            ('r3', [new_dir+'/*'], 'example.com'),
+            ])
+        self.failUnless(app.reload())
+        self.failUnlessEqual(['r1', 'r3'],
+                             sorted(r.name for r in app._relayers))
+        self.assertNotIn(watched[1], app._processors)
+        self.assertNotIn(watched[1], app._watches)
+        self.assertIn(new_dir, app._processors)
+
+    def test_reload_keeps_unchanged_relayers(self):
+        app, config, watched = self._makeReloadableApp()
+        r1 = app._relayers[0]
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*'], 'example.com'),
+            ('r2', [watched[1]+'/*'], 'example.org'),
+            ])
+        app.reload()
+        relayers = dict((r.name, r) for r in app._relayers)
+        self.assertIs(relayers['r1'], r1)
+        self.failUnlessEqual('example.org', relayers['r2'].uploader.host)
+        self.assertEqual([relayers['r2']],
+                         app._processors[watched[1]].relayers)
+
+    def test_reload_reuses_uploader_if_only_paths_change(self):
+        app, config, watched = self._makeReloadableApp()
+        uploader = app._relayers[0].uploader
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*.txt'], 'example.com'),
+            ('r2', [watched[1]+'/*'], 'example.com'),
+            ])
+        app.reload()
+        relayers = dict((r.name, r) for r in app._relayers)
+        self.failUnlessEqual([watched[0]+'/*.txt'], relayers['r1'].paths)
+        self.assertIs(relayers['r1'].uploader, uploader)
+
+    def test_reload_with_invalid_config_keeps_current_one(self):
+        app, config, watched = self._makeReloadableApp()
+        relayers = list(app._relayers)
+        with open(config, 'w') as f:
+            f.write('[logging]\nlevel = NOT_A_LEVEL\n')
+        self.failIf(app.reload())
+        self.failUnlessEqual(relayers, app._relayers)
+
+    def test_reload_with_unknown_uploader_keeps_current_config(self):
+        app, config, watched = self._makeReloadableApp()
+        relayers = list(app._relayers)
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*'], 'example.com'),
+            ])
+        with open(config, 'a') as f:
+            f.write('\n'.join(['    [[r3]]',
+                               '    paths = %s/*,' % watched[1],
+                               '        [[[uploader]]]',
+                               '        use = fpt']) + '\n')
+        self.failIf(app.reload())
+        self.failUnlessEqual(relayers, app._relayers)
+        self.assertEqual([relayers[1]], app._processors[watched[1]].relayers)
+
+    def test_reload_keeps_watch_of_replaced_relayer(self):
+        app, config, watched = self._makeReloadableApp()
+        processor = app._processors[watched[1]]
+        wd = app._watches[watched[1]]
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*'], 'example.com'),
+            ('r2', [watched[1]+'/*.txt'], 'example.org'),
+            ])
+        self.failUnless(app.reload())
+        relayers = dict((r.name, r) for r in app._relayers)
+        self.assertIs(processor, app._processors[watched[1]])
+        self.failUnlessEqual(wd, app._watches[watched[1]])
+        self.assertEqual([relayers['r2']], processor.relayers)
+
+    def test_reload_moves_replaced_relayer_to_new_dir(self):
+        app, config, watched = self._makeReloadableApp()
+        new_dir = self._makeTempDir()
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*'], 'example.com'),
+            ('r2', [new_dir+'/*'], 'example.com'),
+            ])
+        self.failUnless(app.reload())
+        relayers = dict((r.name, r) for r in app._relayers)
+        self.assertNotIn(watched[1], app._processors)
+        self.assertNotIn(watched[1], app._watches)
+        self.assertEqual([relayers['r2']], app._processors[new_dir].relayers)
+
+    def test_reload_and_stop_close_sftp_connections(self):
+        from .. import SCPUploader
+        app, config, watched = self._makeReloadableApp()
+        closed = []
+        class Client(object):
+            def __init__(self, name):
+                self.name = name
+            def close(self):
+                closed.append(self.name)
+        uploader = SCPUploader('example.com', 'pepe', 'secret')
+        app._relayers[0].uploader = uploader
+        self.addCleanup(SCPUploader._pool.clear)
+        SCPUploader._pool[uploader._pool_key] = Client('used')
+        SCPUploader._pool[('example.com', 22, 'pepe', 'old', None)] = \
+            Client('unused')
+        self.failUnless(app.reload())
+        self.failUnlessEqual(['unused'], closed)
+        app.start()
+        app.stop()
+        self.failUnlessEqual(['unused', 'used'], closed)
+
+    def test_queued_files_are_processed_by_removed_relayer(self):
+        app, config, watched = self._makeReloadableApp()
+        state = {'called': False}
+        def process(path):
+            state['called'] = True
+        old = app._relayers[1]
+        old.process = process
+        app._queue.put((old, os.path.join(watched[1], 'foo')))
+        self._writeConfig(config, [
+            ('r1', [watched[0]+'/*'], 'example.com'),
+            ])
+        app.reload()
+        self.addCleanup(app.stop)
+        app.start()
+        time.sleep(.1)
+        self.failUnless(state['called'])
+
 def touch(path):
     dirname = os.path.dirname(path)
     if not os.path.exists(dirname):
@@ -236,6 +464,10 @@ class TestMain(TestCaseWithMox):
         import ftprelayer
         self.assertEqual(-1, ftprelayer.main(['./ftprelayer']))
 
+    def test_replay_too_few_args(self):
+        import ftprelayer
+        self.assertEqual(-1, ftprelayer.main(['./ftprelayer', 'replay']))
+
     def test_good_run(self):
         import ftprelayer
         self.mox.StubOutClassWithMocks(ftprelayer, 'Application')
@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+from unittest2 import TestCase
+
+
+class FakeRelayer(object):
+    def __init__(self, name='test'):
+        self.name = name
+
+
+def _claim_all(dir, node, paths, results):
+    from ..claims import ClaimStore
+    store = ClaimStore(dir, node)
+    relayer = FakeRelayer()
+    claimed = []
+    for path in paths:
+        claim = store.acquire(relayer, path)
+        if claim is not None:
+            claimed.append(path)
+            store.release(claim)
+    results.put(claimed)
+
+
+class TestClaimStore(TestCase):
+    def _makeOne(self, node='node1', lease=60):
+        from ..claims import ClaimStore
+        return ClaimStore(self.claim_dir, node, lease)
+
+    def _makeTempDir(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        return dir
+
+    def _makeFile(self, name='foo.txt', data='foo'):
+        path = os.path.join(self.incoming, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def setUp(self):
+        self.claim_dir = self._makeTempDir()
+        self.incoming = self._makeTempDir()
+
+    def test_only_one_node_can_claim_a_file(self):
+        path = self._makeFile()
+        relayer = FakeRelayer()
+        node1, node2 = self._makeOne('node1'), self._makeOne('node2')
+        self.failIf(node1.acquire(relayer, path) is None)
+        self.failUnless(node2.acquire(relayer, path) is None)
+
+    def test_released_file_is_not_claimed_again(self):
+        path = self._makeFile()
+        relayer = FakeRelayer()
+        node1, node2 = self._makeOne('node1'), self._makeOne('node2')
+        node1.release(node1.acquire(relayer, path))
+        self.failUnless(node2.acquire(relayer, path) is None)
+        self.failUnless(node1.acquire(relayer, path) is None)
+
+    def test_each_relayer_claims_separately(self):
+        path = self._makeFile()
+        node1, node2 = self._makeOne('node1'), self._makeOne('node2')
+        self.failIf(node1.acquire(FakeRelayer('a'), path) is None)
+        self.failIf(node2.acquire(FakeRelayer('b'), path) is None)
+
+    def test_modified_file_can_be_claimed_again(self):
+        path = self._makeFile()
+        relayer = FakeRelayer()
+        node = self._makeOne()
+        node.release(node.acquire(relayer, path))
+        self._makeFile(data='other contents')
+        self.failIf(node.acquire(relayer, path) is None)
+
+    def test_missing_file_is_not_claimed(self):
+        node = self._makeOne()
+        missing = os.path.join(self.incoming, 'missing')
+        self.failUnless(node.acquire(FakeRelayer(), missing) is None)
+
+    def test_expired_claim_can_be_taken_over(self):
+        path = self._makeFile()
+        relayer = FakeRelayer()
+        node1, node2 = self._makeOne('node1'), self._makeOne('node2')
+        node1.acquire(relayer, path)
+        node2.now = lambda: time.time() + 120
+        self.failIf(node2.acquire(relayer, path) is None)
+
+    def test_renewed_claim_is_not_taken_over(self):
+        path = self._makeFile()
+        relayer = FakeRelayer()
+        node1, node2 = self._makeOne('node1'), self._makeOne('node2')
+        claim = node1.acquire(relayer, path)
+        os.utime(claim, (time.time() - 120, time.time() - 120))
+        node1.renew()
+        self.failUnless(node2.acquire(relayer, path) is None)
+
+    def test_sweep_returns_files_of_expired_claims(self):
+        path = self._makeFile()
+        relayer = FakeRelayer()
+        node1, node2 = self._makeOne('node1'), self._makeOne('node2')
+        node1.acquire(relayer, path)
+        self.failUnlessEqual([], node2.sweep())
+        node2.now = lambda: time.time() + 120
+        self.failUnlessEqual([(relayer.name, path)], node2.sweep())
+        self.failIf(node2.acquire(relayer, path) is None)
+
+    def test_sweep_removes_old_done_markers(self):
+        path = self._makeFile()
+        node = self._makeOne()
+        node.release(node.acquire(FakeRelayer(), path))
+        self.failUnlessEqual(1, len(os.listdir(self.claim_dir)))
+        node.now = lambda: time.time() + node.done_retention + 1
+        node.sweep()
+        self.failUnlessEqual([], os.listdir(self.claim_dir))
+
+    def test_files_are_claimed_once_by_concurrent_processes(self):
+        paths = [self._makeFile('f%d' % i) for i in range(50)]
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_claim_all,
+                                         args=(self.claim_dir, 'node%d' % i,
+                                               paths, results))
+                 for i in range(4)]
+        for p in procs:
+            p.start()
+        claimed = []
+        for p in procs:
+            claimed.extend(results.get(True, 30))
+        for p in procs:
+            p.join()
+        self.failUnlessEqual(sorted(paths), sorted(claimed))
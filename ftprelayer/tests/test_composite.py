@@ -1,4 +1,6 @@
 
+import os
+import tempfile
 from . import TestCaseWithMox
 
 class TestCompositeUploader(TestCaseWithMox):
@@ -33,3 +35,63 @@ class TestCompositeUploader(TestCaseWithMox):
         self.mox.ReplayAll()
         ob = self._makeOne([up1, up2])
         ob.upload(filename, data)
+
+    def test_upload_file_delegates_to_uploaders(self):
+        from .. import Uploader
+        filename = 'some_filename'
+        path = '/some/path'
+        up1 = self.mox.CreateMock(Uploader)
+        up1.upload_file(filename, path).AndRaise(RuntimeError)
+        up2 = self.mox.CreateMock(Uploader)
+        up2.upload_file(filename, path)
+        self.mox.ReplayAll()
+        ob = self._makeOne([up1, up2])
+        ob.upload_file(filename, path)
+
+    def test_returns_outcome_of_each_uploader(self):
+        from .. import Uploader
+        up1 = self.mox.CreateMock(Uploader)
+        up1.destination = 'ftp://a'
+        up1.upload_file('f', '/p').AndRaise(RuntimeError('boom'))
+        up2 = self.mox.CreateMock(Uploader)
+        up2.destination = 'ftp://b'
+        up2.upload_file('f', '/p')
+        self.mox.ReplayAll()
+        ob = self._makeOne([up1, up2])
+        self.failUnlessEqual([('ftp://a', "RuntimeError('boom',)"),
+                              ('ftp://b', None)],
+                             ob.upload_file('f', '/p'))
+
+    def test_upload_fileobj_gives_whole_stream_to_each_uploader(self):
+        from ..util import ChunkReader
+        uploaded = []
+        class uploader(object):
+            def upload_fileobj(self, filename, fileobj):
+                uploaded.append((filename, fileobj.read()))
+        ob = self._makeOne([uploader(), uploader()])
+        ob.upload_fileobj('f', ChunkReader(['some ', 'data']))
+        self.failUnlessEqual([('f', 'some data')]*2, uploaded)
+
+    def test_upload_fileobj_falls_back_to_upload(self):
+        from ..util import ChunkReader
+        uploaded = []
+        class uploader(object):
+            def upload(self, filename, data):
+                uploaded.append((filename, data))
+        ob = self._makeOne([uploader()])
+        ob.upload_fileobj('f', ChunkReader(['some ', 'data']))
+        self.failUnlessEqual([('f', 'some data')], uploaded)
+
+    def test_upload_file_falls_back_to_upload(self):
+        from .. import Relayer
+        uploaded = []
+        class ThirdParty(object):
+            def upload(self, filename, data):
+                uploaded.append((filename, data))
+        f = tempfile.NamedTemporaryFile()
+        f.write('some data')
+        f.flush()
+        relayer = Relayer('test', self._makeOne([ThirdParty()]), [])
+        self.failUnlessEqual({'ThirdParty': None}, relayer.process(f.name))
+        self.failUnlessEqual([(os.path.basename(f.name), 'some data')],
+                             uploaded)
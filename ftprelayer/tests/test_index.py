@@ -0,0 +1,112 @@
+import os
+import shutil
+import datetime
+import tempfile
+from unittest2 import TestCase
+
+
+class TestArchiveIndex(TestCase):
+    def _makeOne(self):
+        from ..index import ArchiveIndex
+        ob = ArchiveIndex(os.path.join(self.dir, 'index.sqlite'))
+        self.addCleanup(ob.close)
+        return ob
+
+    def _makeFile(self, name='foo.txt', data='foo'):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_add(self):
+        import hashlib
+        ob = self._makeOne()
+        path = self._makeFile(data='some data')
+        when = datetime.datetime(2014, 3, 1, 10, 20, 30)
+        ob.add('relayer', '/incoming/foo.txt', path, when,
+               outcomes={'ftp://a': None})
+        ob.flush()
+        files = ob.query()
+        self.failUnlessEqual(1, len(files))
+        f = files[0]
+        self.failUnlessEqual('relayer', f.relayer)
+        self.failUnlessEqual('/incoming/foo.txt', f.source)
+        self.failUnlessEqual(path, f.path)
+        self.failUnlessEqual(9, f.size)
+        self.failUnlessEqual(hashlib.sha1('some data').hexdigest(), f.sha1)
+        self.failUnlessEqual('2014-03-01 10:20:30', f.archived_at)
+        self.failIf(f.failed)
+        self.failUnlessEqual([], f.failed_destinations)
+
+    def test_non_ascii_paths(self):
+        ob = self._makeOne()
+        path = self._makeFile('a\xc3\xb1o.txt')
+        latin1 = os.path.join(self.dir, 'a\xf1o.txt')
+        ob.add('relayer', latin1, path, datetime.datetime(2014, 3, 1))
+        [f] = ob.query()
+        self.failUnlessEqual(path, f.path)
+        self.failUnlessEqual(latin1, f.source)
+        self.assertIsInstance(f.path, str)
+
+    def test_index_of_older_version_is_upgraded(self):
+        import sqlite3
+        db = sqlite3.connect(os.path.join(self.dir, 'index.sqlite'))
+        db.execute('CREATE TABLE files (id INTEGER PRIMARY KEY,'
+                   ' relayer TEXT NOT NULL, source TEXT NOT NULL,'
+                   ' path TEXT NOT NULL, size INTEGER, sha1 TEXT,'
+                   ' archived_at TEXT NOT NULL, failed INTEGER NOT NULL)')
+        db.close()
+        ob = self._makeOne()
+        file_id = ob.add('relayer', '/in/foo', self._makeFile(),
+                         datetime.datetime(2014, 3, 1), failed=True)
+        ob.mark_injected(file_id, datetime.datetime(2014, 3, 2))
+        self.failUnlessEqual([], ob.query(failed=True))
+        self.failUnlessEqual(['2014-03-02 00:00:00'],
+                             [f.injected_at for f in ob.query()])
+
+    def test_query_by_relayer_and_time(self):
+        ob = self._makeOne()
+        path = self._makeFile()
+        day = datetime.datetime(2014, 3, 1)
+        for i, relayer in enumerate(['a', 'b', 'a', 'c']):
+            ob.add(relayer, '/in/%d' % i, path, day+datetime.timedelta(hours=i))
+        self.failUnlessEqual(['/in/0', '/in/2', '/in/3'],
+                             [f.source for f in ob.query(relayers=['a', 'c'])])
+        self.failUnlessEqual(['/in/1', '/in/2'],
+                             [f.source for f in ob.query(
+                                 since=day+datetime.timedelta(hours=1),
+                                 until=day+datetime.timedelta(hours=3))])
+
+    def test_query_failed(self):
+        ob = self._makeOne()
+        path = self._makeFile()
+        when = datetime.datetime(2014, 3, 1)
+        ob.add('r', '/in/ok', path, when,
+               outcomes={'ftp://a': None, 'ftp://b': None})
+        ob.add('r', '/in/partial', path, when,
+               outcomes={'ftp://a': None, 'ftp://b': 'error'})
+        ob.add('r', '/in/failed', path, when, failed=True,
+               outcomes={'ftp://a': 'error', 'ftp://b': 'error'})
+        files = ob.query(failed=True)
+        self.failUnlessEqual(['/in/partial', '/in/failed'],
+                             [f.source for f in files])
+        self.failUnlessEqual(['ftp://b'], files[0].failed_destinations)
+        self.failUnless(files[1].failed)
+        files = ob.query(failed=True, destination='ftp://a')
+        self.failUnlessEqual(['/in/failed'], [f.source for f in files])
+
+    def test_last_outcome_of_each_destination_counts(self):
+        ob = self._makeOne()
+        path = self._makeFile()
+        when = datetime.datetime(2014, 3, 1)
+        file_id = ob.add('r', '/in/foo', path, when, failed=True,
+                         outcomes={'ftp://a': 'error', 'ftp://b': 'error'})
+        ob.record_outcomes(file_id, {'ftp://a': None}, when)
+        files = ob.query(failed=True)
+        self.failUnlessEqual(['ftp://b'], files[0].failed_destinations)
+        ob.record_outcomes(file_id, {'ftp://b': None}, when, failed=False)
+        self.failUnlessEqual([], ob.query(failed=True))
@@ -1,4 +1,6 @@
 import os
+import zlib
+import hashlib
 import tempfile
 from . import TestCaseWithMox
 
@@ -14,12 +16,106 @@ class TestRelayer(TestCaseWithMox):
         data = 'some data'
         f.write(data)
         f.flush()
-        uploader.upload(os.path.basename(f.name), data)
+        uploader.upload_file(os.path.basename(f.name), f.name)
         self.mox.ReplayAll()
 
         ob = self._makeOne(uploader=uploader)
         ob.process(f.name)
 
+    def test_process_without_processor_with_uploader_without_upload_file(self):
+        uploaded = []
+        class uploader(object):
+            def upload(self, filename, data):
+                uploaded.append((filename, data))
+        f = tempfile.NamedTemporaryFile()
+        data = 'some data'
+        f.write(data)
+        f.flush()
+
+        ob = self._makeOne(uploader=uploader())
+        ob.process(f.name)
+        self.failUnlessEqual([(os.path.basename(f.name), data)], uploaded)
+
+    def test_process_returns_outcomes(self):
+        from .. import FTPUploader
+        uploader = self.mox.CreateMock(FTPUploader)
+        uploader.destination = 'ftp://foo@host/'
+        f = tempfile.NamedTemporaryFile()
+        uploader.upload_file(os.path.basename(f.name), f.name)
+        self.mox.ReplayAll()
+
+        ob = self._makeOne(uploader=uploader)
+        self.failUnlessEqual({'ftp://foo@host/': None}, ob.process(f.name))
+
+    def test_process_streams_through_pipeline(self):
+        from .. import Pipeline, add_prefix, gzip_compress
+        uploaded = {}
+        class uploader(object):
+            def upload_fileobj(self, filename, fileobj):
+                uploaded[filename] = fileobj.read()
+        f = tempfile.NamedTemporaryFile()
+        data = 'some data' * 10000
+        f.write(data)
+        f.flush()
+
+        processor = Pipeline([add_prefix('pre_'), gzip_compress()])
+        ob = self._makeOne(uploader=uploader(), processor=processor)
+        ob.process(f.name)
+        name = 'pre_' + os.path.basename(f.name) + '.gz'
+        self.failUnlessEqual([name], list(uploaded))
+        self.failUnlessEqual(data, zlib.decompress(uploaded[name],
+                                                   16 + zlib.MAX_WBITS))
+
+    def test_process_with_processor_which_yields_contents(self):
+        from .. import Uploader
+        uploader = self.mox.CreateMock(Uploader)
+        f = tempfile.NamedTemporaryFile()
+        def processor(path):
+            yield 'foo.txt', 'some data'
+        uploader.upload('foo.txt', 'some data')
+        self.mox.ReplayAll()
+
+        ob = self._makeOne(uploader=uploader, processor=processor)
+        ob.process(f.name)
+        self.mox.VerifyAll()
+
+    def test_pipeline_stops_relaying_to_failed_destinations(self):
+        from .. import (CompositeUploader, Pipeline, checksum_sidecar,
+                        add_prefix)
+        class uploader(object):
+            def __init__(self, destination, fail=False):
+                self.destination = destination
+                self.fail = fail
+                self.uploaded = {}
+            def upload(self, filename, data):
+                self.uploaded[filename] = data
+            def upload_fileobj(self, filename, fileobj):
+                data = fileobj.read(3)
+                if self.fail:
+                    raise IOError('broken pipe')
+                self.uploaded[filename] = data + fileobj.read()
+        a, b = uploader('a', fail=True), uploader('b')
+        f = tempfile.NamedTemporaryFile()
+        data = os.urandom(200*1024)
+        f.write(data)
+        f.flush()
+        name = os.path.basename(f.name)
+
+        processor = Pipeline([add_prefix(''), checksum_sidecar()])
+        ob = self._makeOne(uploader=CompositeUploader([a]),
+                           processor=processor)
+        self.failUnlessEqual(['a'], list(ob.process(f.name)))
+        ob = self._makeOne(uploader=CompositeUploader([a, b]),
+                           processor=processor)
+        outcomes = ob.process(f.name)
+        self.failUnlessEqual(['a', 'b'], sorted(outcomes))
+        self.failIf(outcomes['a'] is None)
+        self.failUnless(outcomes['b'] is None)
+        self.failUnlessEqual({}, a.uploaded)
+        self.failUnlessEqual({name: data, name + '.md5': '%s  %s\n' % (
+                              hashlib.md5(data).hexdigest(), name)},
+                             b.uploaded)
+
     def test_relpathto(self):
         ob = self._makeOne(paths=['/var/zoo/bar/*', '/var/zoo/car/*'])
         self.failUnlessEqual('bar/foo.txt',
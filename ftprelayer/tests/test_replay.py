@@ -0,0 +1,192 @@
+import os
+import time
+import shutil
+import datetime
+import tempfile
+from threading import Thread, Event
+from unittest2 import TestCase
+
+
+class RecordingUploader(object):
+    def __init__(self, destination, error=None):
+        self.destination = destination
+        self.error = error
+        self.uploaded = []
+
+    def upload_file(self, filename, path):
+        if self.error is not None:
+            raise self.error
+        with open(path) as f:
+            self.uploaded.append((filename, f.read()))
+
+
+class TestReplayer(TestCase):
+    now = datetime.datetime(2014, 3, 1)
+
+    def setUp(self):
+        from .. import Application
+        from ..index import ArchiveIndex
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.incoming = os.path.join(self.dir, 'incoming')
+        os.makedirs(self.incoming)
+        self.index = ArchiveIndex(os.path.join(self.dir, 'index.sqlite'))
+        self.addCleanup(self.index.close)
+        self.app = Application(archive_dir=os.path.join(self.dir, 'archive'))
+        self.app.now = lambda: self.now
+
+    def _makeRelayer(self, uploader, name='test'):
+        from .. import Relayer
+        relayer = Relayer(name, uploader, [self.incoming + '/*'])
+        self.app.add_relayer(relayer)
+        return relayer
+
+    def _archive(self, relayer, name='foo.txt', data='foo', **kw):
+        source = os.path.join(self.incoming, name)
+        path = self.app._archive_path(relayer, source)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+        self.index.add(relayer.name, source, path, self.now, **kw)
+        return path
+
+    def _makeOne(self, **kw):
+        from ..replay import Replayer
+        return Replayer(self.app, self.index, **kw)
+
+    def test_replays_to_all_destinations(self):
+        from .. import CompositeUploader
+        a, b = RecordingUploader('a'), RecordingUploader('b')
+        relayer = self._makeRelayer(CompositeUploader([a, b]))
+        self._archive(relayer)
+        ok, failed = self._makeOne().run(self.index.query())
+        self.failUnlessEqual((1, 0), (ok, failed))
+        self.failUnlessEqual([('foo.txt', 'foo')], a.uploaded)
+        self.failUnlessEqual([('foo.txt', 'foo')], b.uploaded)
+
+    def test_replays_failed_destinations_only(self):
+        from .. import CompositeUploader
+        a, b = RecordingUploader('a'), RecordingUploader('b')
+        relayer = self._makeRelayer(CompositeUploader([a, b]))
+        self._archive(relayer, outcomes={'a': None, 'b': 'error'})
+        self._archive(relayer, 'bar.txt', outcomes={'a': None, 'b': None})
+        files = self.index.query(failed=True)
+        ok, failed = self._makeOne(only_failed=True).run(files)
+        self.failUnlessEqual((1, 0), (ok, failed))
+        self.failUnlessEqual([], a.uploaded)
+        self.failUnlessEqual([('foo.txt', 'foo')], b.uploaded)
+        self.failUnlessEqual([], self.index.query(failed=True))
+
+    def test_failures_are_recorded(self):
+        relayer = self._makeRelayer(RecordingUploader('a', RuntimeError()))
+        self._archive(relayer)
+        ok, failed = self._makeOne().run(self.index.query())
+        self.failUnlessEqual((0, 1), (ok, failed))
+        files = self.index.query(failed=True)
+        self.failUnlessEqual(['a'], files[0].failed_destinations)
+
+    def test_only_to_destination(self):
+        from .. import CompositeUploader
+        a, b = RecordingUploader('a'), RecordingUploader('b')
+        relayer = self._makeRelayer(CompositeUploader([a, b]))
+        self._archive(relayer)
+        self._makeOne(destination='b').run(self.index.query())
+        self.failUnlessEqual([], a.uploaded)
+        self.failUnlessEqual([('foo.txt', 'foo')], b.uploaded)
+
+    def test_replays_under_original_name(self):
+        a = RecordingUploader('a')
+        relayer = self._makeRelayer(a)
+        self._archive(relayer, data='first')
+        path = self._archive(relayer, data='second')
+        self.failUnlessEqual('foo.txt.1', os.path.basename(path))
+        self._makeOne().run(self.index.query())
+        self.failUnlessEqual([('foo.txt', 'first'), ('foo.txt', 'second')],
+                             sorted(a.uploaded))
+
+    def test_concurrency(self):
+        a = RecordingUploader('a')
+        relayer = self._makeRelayer(a)
+        for i in range(20):
+            self._archive(relayer, 'f%d' % i, data=str(i))
+        ok, failed = self._makeOne(concurrency=5).run(self.index.query())
+        self.failUnlessEqual((20, 0), (ok, failed))
+        self.failUnlessEqual(sorted(str(i) for i in range(20)),
+                             sorted(data for _, data in a.uploaded))
+
+    def test_unknown_relayer(self):
+        self._archive(self._makeRelayer(RecordingUploader('a'), 'other'))
+        self.app.remove_relayer(self.app._relayers[0])
+        ok, failed = self._makeOne().run(self.index.query())
+        self.failUnlessEqual((0, 1), (ok, failed))
+
+    def test_inject(self):
+        a = RecordingUploader('a')
+        relayer = self._makeRelayer(a)
+        path = self._archive(relayer)
+        ok, failed = self._makeOne(inject=True).run(self.index.query())
+        self.failUnlessEqual((1, 0), (ok, failed))
+        self.failUnlessEqual([], a.uploaded)
+        self.failUnless(os.path.exists(path))
+        with open(os.path.join(self.incoming, 'foo.txt')) as f:
+            self.failUnlessEqual('foo', f.read())
+        self.failUnlessEqual(['foo.txt'], os.listdir(self.incoming))
+
+    def test_inject_does_not_overwrite(self):
+        relayer = self._makeRelayer(RecordingUploader('a'))
+        self._archive(relayer)
+        with open(os.path.join(self.incoming, 'foo.txt'), 'w') as f:
+            f.write('new')
+        ok, failed = self._makeOne(inject=True).run(self.index.query())
+        self.failUnlessEqual((0, 1), (ok, failed))
+
+    def test_injected_files_are_no_longer_failed(self):
+        relayer = self._makeRelayer(RecordingUploader('a'))
+        self._archive(relayer, failed=True)
+        files = self.index.query(failed=True)
+        ok, failed = self._makeOne(only_failed=True, inject=True).run(files)
+        self.failUnlessEqual((1, 0), (ok, failed))
+        self.failUnlessEqual([], self.index.query(failed=True))
+        [f] = self.index.query()
+        self.failUnlessEqual('2014-03-01 00:00:00', f.injected_at)
+
+    def test_inject_refuses_files_which_failed_partially(self):
+        relayer = self._makeRelayer(RecordingUploader('a'))
+        self._archive(relayer, outcomes={'a': None, 'b': 'error'})
+        files = self.index.query(failed=True)
+        ok, failed = self._makeOne(only_failed=True, inject=True).run(files)
+        self.failUnlessEqual((0, 1), (ok, failed))
+        self.failUnlessEqual([], os.listdir(self.incoming))
+
+    def test_inject_to_destination_is_rejected(self):
+        self.assertRaises(ValueError, self._makeOne, inject=True,
+                          destination='a')
+
+    def test_files_with_same_source_are_injected_one_at_a_time(self):
+        relayer = self._makeRelayer(RecordingUploader('a'))
+        self._archive(relayer, data='first')
+        self._archive(relayer, data='second')
+        self._archive(relayer, 'bar.txt', data='other')
+        relayed, stop = [], Event()
+        def relay():
+            # Like a running ftprelayer: archives whatever arrives
+            while not stop.isSet():
+                for name in sorted(os.listdir(self.incoming)):
+                    path = os.path.join(self.incoming, name)
+                    time.sleep(.05)
+                    with open(path) as f:
+                        relayed.append(f.read())
+                    os.remove(path)
+                time.sleep(.01)
+        daemon = Thread(target=relay)
+        daemon.start()
+        self.addCleanup(daemon.join)
+        self.addCleanup(stop.set)
+        ob = self._makeOne(inject=True, concurrency=4)
+        ob.inject_poll = .01
+        ok, failed = ob.run(self.index.query())
+        self.failUnlessEqual((3, 0), (ok, failed))
+        while os.listdir(self.incoming):
+            time.sleep(.01)
+        self.failUnlessEqual(['first', 'other', 'second'], sorted(relayed))
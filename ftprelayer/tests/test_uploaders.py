@@ -1,4 +1,5 @@
-from mox import IgnoreArg, Func
+import os
+from mox import IgnoreArg, Func, IsA
 from . import TestCaseWithMox
 
 
@@ -36,3 +37,363 @@ class TestFTPUploader(TestCaseWithMox):
         self.mox.ReplayAll()
 
         ob.upload(filename, data)
+
+    def test_upload_file(self):
+        import socket
+        import tempfile
+
+        filename = 'some_file'
+        data = 'some_data' * 1000
+        host = 'host'
+        username = 'uname'
+        password = 'foo'
+        remotedir = '/foo/bar'
+        f = tempfile.NamedTemporaryFile()
+        f.write(data)
+        f.flush()
+        client, server = socket.socketpair()
+        self.addCleanup(server.close)
+
+        ob = self._makeOne(host, username, password, remotedir)
+        ftp = ob.FTPHost = self.mox.CreateMockAnything()
+        session = ftp._session = self.mox.CreateMockAnything()
+
+        ftp(host, username, password).AndReturn(ftp)
+        ftp.__enter__().AndReturn(ftp)
+        ftp.makedirs(remotedir+'/')
+        session.voidcmd('TYPE I')
+        session.transfercmd('STOR '+remotedir+'/'+filename).AndReturn(client)
+        session.voidresp()
+        ftp.__exit__(None, None, None)
+
+        self.mox.ReplayAll()
+
+        ob.upload_file(filename, f.name)
+        received = []
+        while True:
+            chunk = server.recv(65536)
+            if not chunk:
+                break
+            received.append(chunk)
+        self.failUnlessEqual(data, ''.join(received))
+
+
+class Test_stor_file(TestCaseWithMox):
+    data = 'some_data' * 10000
+
+    def setUp(self):
+        import tempfile
+        super(Test_stor_file, self).setUp()
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.write(self.data)
+        self.file.flush()
+        self.f = open(self.file.name, 'rb')
+        self.addCleanup(self.f.close)
+
+    def _makeSession(self, conn, succeeds=True):
+        session = self.mox.CreateMockAnything()
+        session.voidcmd('TYPE I')
+        session.transfercmd('STOR /foo').AndReturn(conn)
+        if succeeds:
+            session.voidresp()
+        self.mox.ReplayAll()
+        return session
+
+    def _stor_file(self, session, chunk_size=4096):
+        from .. import _stor_file
+        _stor_file(session, '/foo', self.f, chunk_size)
+        self.mox.VerifyAll()
+
+    def _stubSendfile(self, sendfile):
+        import ftprelayer
+        self.mox.stubs.Set(ftprelayer, '_sendfile', sendfile)
+
+    def test_sendfile(self):
+        def sendfile(out_fd, in_fd, offset, count):
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            return os.write(out_fd, os.read(in_fd, min(count, 1000)))
+        self._stubSendfile(sendfile)
+        conn = FakeConn()
+        self._stor_file(self._makeSession(conn))
+        self.failUnlessEqual(self.data, conn.received())
+
+    def test_sendfile_short_transfer(self):
+        self._stubSendfile(lambda out_fd, in_fd, offset, count: 0)
+        session = self._makeSession(FakeConn(), succeeds=False)
+        self.assertRaises(IOError, self._stor_file, session)
+
+    def test_buffered_short_transfer(self):
+        self._stubSendfile(None)
+        # The file is truncated while it is sent
+        conn = FakeConn(on_send=lambda: os.ftruncate(self.file.fileno(), 5000))
+        session = self._makeSession(conn, succeeds=False)
+        self.assertRaises(IOError, self._stor_file, session)
+
+    def test_mmaped(self):
+        from .. import _send_mmaped
+        conn = FakeConn()
+        _send_mmaped(conn, self.f, len(self.data), 1)
+        self.failUnlessEqual(self.data, conn.received())
+
+    def test_mmaped_short_transfer(self):
+        import mmap
+        from .. import _send_mmaped
+        conn = FakeConn(on_send=lambda: os.ftruncate(self.file.fileno(), 5000))
+        self.assertRaises(IOError, _send_mmaped, conn, self.f,
+                          len(self.data), mmap.ALLOCATIONGRANULARITY)
+
+
+class FakeConn(object):
+    """
+    A data connection which writes to a temporary file.
+    """
+    def __init__(self, on_send=None):
+        import tempfile
+        self.file = tempfile.TemporaryFile()
+        self.on_send = on_send
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def sendall(self, data):
+        self.file.write(data)
+        self.file.flush()
+        if self.on_send is not None:
+            self.on_send()
+
+    def received(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        pass
+
+
+class TestUploader(TestCaseWithMox):
+    def test_upload_file_delegates_to_upload(self):
+        import tempfile
+        from .. import Uploader
+        f = tempfile.NamedTemporaryFile()
+        f.write('some_data')
+        f.flush()
+        ob = Uploader('host', 'foo')
+        self.mox.StubOutWithMock(ob, 'upload')
+        ob.upload('some_file', 'some_data')
+        self.mox.ReplayAll()
+
+        ob.upload_file('some_file', f.name)
+
+
+class TestDAVUploader(TestCaseWithMox):
+    def _makeOne(self):
+        from .. import DAVUploader
+        sent = []
+        class DAVClient(object):
+            def __init__(self, host):
+                pass
+            def set_basic_auth(self, username, password):
+                pass
+            def put(self, path, body=None, headers=None):
+                sent.append((path, body, headers, body.read()))
+                self.response = type('Response', (), {'status': 201})
+        ob = DAVUploader('http://example.com/', 'foo', 'bar')
+        ob.DAVClient = DAVClient
+        return ob, sent
+
+    def test_upload_file_sends_the_file(self):
+        import tempfile
+        ob, sent = self._makeOne()
+        f = tempfile.NamedTemporaryFile()
+        f.write('some_data')
+        f.flush()
+        ob.upload_file('some_file', f.name)
+        [(path, body, headers, data)] = sent
+        self.failUnlessEqual('http://example.com/some_file', path)
+        self.failUnlessEqual(f.name, body.name)
+        self.failUnlessEqual({'Content-Length': '9'}, headers)
+        self.failUnlessEqual('some_data', data)
+
+    def test_upload_fileobj(self):
+        from ..util import ChunkReader
+        ob, sent = self._makeOne()
+        ob.upload_fileobj('some_file', ChunkReader(['some_', 'data']))
+        [(path, body, headers, data)] = sent
+        self.failUnlessEqual({'Content-Length': '9'}, headers)
+        self.failUnlessEqual('some_data', data)
+
+
+class TestSCPUploader(TestCaseWithMox):
+    def setUp(self):
+        super(TestSCPUploader, self).setUp()
+        from .. import SCPUploader
+        SCPUploader._pool.clear()
+        SCPUploader._idle_channels.clear()
+        SCPUploader._busy.clear()
+        self.addCleanup(SCPUploader._pool.clear)
+        self.addCleanup(SCPUploader._idle_channels.clear)
+        self.addCleanup(SCPUploader._busy.clear)
+
+    def _makeOne(self, host='host', username='foo', password='bar',
+                 dir='/foo/bar', **kw):
+        from .. import SCPUploader
+        ob = SCPUploader(host, username, password, dir, **kw)
+        ob.SSHClient = self.mox.CreateMockAnything()
+        ob.SFTPClient = self.mox.CreateMockAnything()
+        return ob
+
+    def _expectConnect(self, ob):
+        import paramiko
+        client = self.mox.CreateMockAnything()
+        ob.SSHClient().AndReturn(client)
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(IsA(paramiko.RejectPolicy))
+        client.connect(ob.host, port=22, username=ob.username,
+                       password=ob.password, key_filename=None,
+                       look_for_keys=False)
+        return client
+
+    def _expectSFTP(self, ob, client, transport):
+        sftp = self.mox.CreateMockAnything()
+        client.get_transport().AndReturn(transport)
+        ob.SFTPClient.from_transport(transport, window_size=ob.window_size
+                                     ).AndReturn(sftp)
+        return sftp
+
+    def test_upload(self):
+        ob = self._makeOne()
+        client = self._expectConnect(ob)
+        transport = self.mox.CreateMockAnything()
+        sftp = self._expectSFTP(ob, client, transport)
+        sftp.stat('/foo')
+        sftp.stat('/foo/bar').AndRaise(IOError)
+        sftp.mkdir('/foo/bar')
+        sftp.putfo(Func(lambda f: f.read() == 'some_data'),
+                   '/foo/bar/some_file')
+        self.mox.ReplayAll()
+
+        ob.upload('some_file', 'some_data')
+        self.mox.VerifyAll()
+
+    def test_connection_and_channel_are_reused(self):
+        ob = self._makeOne()
+        ob2 = self._makeOne()
+        ob2.SSHClient = ob.SSHClient
+        client = self._expectConnect(ob)
+        transport = self.mox.CreateMockAnything()
+        sftp = self._expectSFTP(ob, client, transport)
+        sftp.stat(IgnoreArg()).MultipleTimes()
+        sftp.putfo(IgnoreArg(), '/foo/bar/file1')
+        client.get_transport().AndReturn(transport)
+        transport.is_active().AndReturn(True)
+        channel = self.mox.CreateMockAnything()
+        channel.closed = False
+        sftp.get_channel().AndReturn(channel)
+        sftp.stat(IgnoreArg()).MultipleTimes()
+        sftp.putfo(IgnoreArg(), '/foo/bar/file2')
+        self.mox.ReplayAll()
+
+        ob.upload('file1', 'data1')
+        ob2.upload('file2', 'data2')
+        self.mox.VerifyAll()
+
+    def test_closed_channel_is_not_reused(self):
+        ob = self._makeOne(dir='/')
+        client = self._expectConnect(ob)
+        transport = self.mox.CreateMockAnything()
+        sftp = self._expectSFTP(ob, client, transport)
+        sftp.putfo(IgnoreArg(), '/file1')
+        client.get_transport().AndReturn(transport)
+        transport.is_active().AndReturn(True)
+        channel = self.mox.CreateMockAnything()
+        channel.closed = True
+        sftp.get_channel().AndReturn(channel)
+        sftp2 = self._expectSFTP(ob, client, transport)
+        sftp2.putfo(IgnoreArg(), '/file2')
+        self.mox.ReplayAll()
+
+        ob.upload('file1', 'data1')
+        ob.upload('file2', 'data2')
+        self.mox.VerifyAll()
+
+    def test_dead_connection_is_replaced(self):
+        ob = self._makeOne()
+        transport = self.mox.CreateMockAnything()
+        client = self._expectConnect(ob)
+        sftp = self._expectSFTP(ob, client, transport)
+        sftp.stat(IgnoreArg()).MultipleTimes()
+        sftp.putfo(IgnoreArg(), '/foo/bar/file1').AndRaise(EOFError)
+        sftp.close()
+        client.get_transport().AndReturn(transport)
+        transport.is_active().AndReturn(False)
+        client.close()
+        transport2 = self.mox.CreateMockAnything()
+        client2 = self._expectConnect(ob)
+        sftp2 = self._expectSFTP(ob, client2, transport2)
+        sftp2.stat(IgnoreArg()).MultipleTimes()
+        sftp2.putfo(IgnoreArg(), '/foo/bar/file1')
+        self.mox.ReplayAll()
+
+        self.assertRaises(EOFError, ob.upload, 'file1', 'data1')
+        ob.upload('file1', 'data1')
+        self.mox.VerifyAll()
+
+    def test_atomic_upload(self):
+        ob = self._makeOne(dir='/', atomic=True)
+        client = self._expectConnect(ob)
+        sftp = self._expectSFTP(ob, client, self.mox.CreateMockAnything())
+        sftp.putfo(IgnoreArg(), '/.some_file.part')
+        sftp.posix_rename('/.some_file.part', '/some_file')
+        self.mox.ReplayAll()
+
+        ob.upload('some_file', 'some_data')
+        self.mox.VerifyAll()
+
+    def test_atomic_upload_without_posix_rename(self):
+        ob = self._makeOne(dir='/', atomic=True)
+        client = self._expectConnect(ob)
+        sftp = self._expectSFTP(ob, client, self.mox.CreateMockAnything())
+        sftp.putfo(IgnoreArg(), '/.some_file.part')
+        sftp.posix_rename('/.some_file.part', '/some_file').AndRaise(IOError)
+        sftp.remove('/some_file')
+        sftp.rename('/.some_file.part', '/some_file')
+        self.mox.ReplayAll()
+
+        ob.upload('some_file', 'some_data')
+        self.mox.VerifyAll()
+
+    def test_close(self):
+        from .. import SCPUploader
+        ob = self._makeOne(dir='/')
+        other = self._makeOne(host='other', dir='/')
+        other.SSHClient = ob.SSHClient
+        client = self._expectConnect(ob)
+        sftp = self._expectSFTP(ob, client, self.mox.CreateMockAnything())
+        sftp.putfo(IgnoreArg(), '/file1')
+        client2 = self._expectConnect(other)
+        sftp2 = self._expectSFTP(other, client2, self.mox.CreateMockAnything())
+        sftp2.putfo(IgnoreArg(), '/file1')
+        sftp.close()
+        client.close()
+        self.mox.ReplayAll()
+
+        ob.upload('file1', 'data1')
+        other.upload('file1', 'data1')
+        SCPUploader.close(keep=[other._pool_key])
+        self.mox.VerifyAll()
+        self.failUnlessEqual([other._pool_key], list(SCPUploader._pool))
+
+    def test_close_during_upload(self):
+        from .. import SCPUploader
+        ob = self._makeOne(dir='/')
+        client = self._expectConnect(ob)
+        sftp = self._expectSFTP(ob, client, self.mox.CreateMockAnything())
+        sftp.putfo(IgnoreArg(), '/file1').WithSideEffects(
+            lambda *args: SCPUploader.close())
+        sftp.close()
+        client.close()
+        self.mox.ReplayAll()
+
+        ob.upload('file1', 'data1')
+        self.mox.VerifyAll()
+        self.failUnlessEqual({}, SCPUploader._pool)
+        self.failUnlessEqual({}, SCPUploader._idle_channels)
@@ -1,4 +1,8 @@
 import os
+import zlib
+import types
+import hashlib
+import datetime
 from unittest import TestCase
 import tempfile
 import zipfile
@@ -30,3 +34,96 @@ class Test_add_prefix_to_zip_contents(TestCase):
         self.failUnlessEqual(len(files), len(zfile.filelist))
         for f in zfile.filelist:
             self.failUnless(f.filename.startswith(prefix))
+
+
+class TestPipeline(TestCase):
+    def _makeOne(self, *processors):
+        from .. import Pipeline
+        return Pipeline(processors)
+
+    def _makeFile(self, data):
+        f = tempfile.NamedTemporaryFile()
+        f.write(data)
+        f.flush()
+        return f
+
+    def _stream(self, ob, f):
+        from ..util import FileChunks
+        items = [(os.path.basename(f.name), FileChunks(f.name, 1024))]
+        return [(name, ''.join(chunks)) for name, chunks in ob.stream(items)]
+
+    def test_gzip_and_checksum(self):
+        from .. import gzip_compress, checksum_sidecar
+        data = 'some data' * 1000
+        f = self._makeFile(data)
+        name = os.path.basename(f.name)
+        ob = self._makeOne(gzip_compress(), checksum_sidecar('sha1'))
+
+        (gz_name, gz), (sum_name, sum) = self._stream(ob, f)
+        self.failUnlessEqual(name + '.gz', gz_name)
+        self.failUnlessEqual(data, zlib.decompress(gz, 16 + zlib.MAX_WBITS))
+        self.failUnlessEqual(name + '.gz.sha1', sum_name)
+        self.failUnlessEqual('%s  %s.gz\n' % (hashlib.sha1(gz).hexdigest(),
+                                              name), sum)
+
+    def test_no_checksum_of_partially_read_stream(self):
+        from .. import checksum_sidecar
+        ob = self._makeOne(checksum_sidecar())
+        items = ob.stream([('foo', ['a', 'b'])])
+        name, chunks = next(items)
+        next(chunks)
+        self.failUnlessEqual([], list(items))
+
+    def test_stages_are_lazy(self):
+        from .. import add_prefix, gzip_compress
+        ob = self._makeOne(add_prefix('pre_'), gzip_compress())
+        items = ob.stream([('foo', iter(['a', 'b']))])
+        name, chunks = next(items)
+        self.failUnlessEqual('pre_foo.gz', name)
+        self.assertIsInstance(chunks, types.GeneratorType)
+
+    def test_processor_which_yields_contents_is_adapted(self):
+        from .. import add_date_prefix, add_prefix_to_zip_contents
+        f = tempfile.NamedTemporaryFile(suffix='.zip')
+        zip = zipfile.ZipFile(f.name, 'w')
+        zip.writestr('a', 'data')
+        zip.close()
+        date_prefix = add_date_prefix('%Y_')
+        date_prefix.now = lambda: datetime.datetime(2007, 3, 1)
+        # The zip processor receives a file named as the renamed stream
+        ob = self._makeOne(date_prefix, add_prefix_to_zip_contents('p_'))
+
+        [(name, data)] = self._stream(ob, f)
+        self.failUnlessEqual('2007_' + os.path.basename(f.name), name)
+        zfile = zipfile.ZipFile(StringIO(data))
+        self.failUnlessEqual(['p_a'], [zi.filename for zi in zfile.filelist])
+
+    def test_can_be_called_as_a_processor(self):
+        from .. import add_prefix
+        f = self._makeFile('some data')
+        ob = self._makeOne(add_prefix('pre_'))
+        self.failUnlessEqual([('pre_' + os.path.basename(f.name),
+                               'some data')], list(ob(f.name)))
+
+
+class Test_lazy_import(TestCase):
+    def _makeClass(self, name):
+        from ..util import lazy_import
+        class Foo(object):
+            attr = lazy_import(name)
+        return Foo
+
+    def test_imports_on_access(self):
+        import os.path
+        Foo = self._makeClass('os.path:join')
+        self.assertIs(os.path.join, Foo.attr)
+        self.assertIs(os.path.join, Foo().attr)
+
+    def test_can_be_overriden_in_instance(self):
+        ob = self._makeClass('os.path:join')()
+        ob.attr = 'mock'
+        self.failUnlessEqual('mock', ob.attr)
+
+    def test_missing_module_fails_on_access_only(self):
+        Foo = self._makeClass('some_missing_module:Foo')
+        self.assertRaises(ImportError, getattr, Foo, 'attr')
@@ -1,5 +1,81 @@
-import pkg_resources
+import sys
+from importlib import import_module
+
 def import_string(s):
+    """
+    Imports an object given its ``module:attribute`` path. The attribute
+    may be dotted and is optional. Non-string arguments are returned as-is.
+
+        >>> import_string('os.path:join') is sys.modules['os.path'].join
+        True
+        >>> import_string('os.path') is sys.modules['os.path']
+        True
+        >>> import_string(None)
+    """
     if isinstance(s, basestring):
-        return pkg_resources.EntryPoint.parse('x='+s).load(False)
+        module, _, attrs = s.strip().partition(':')
+        obj = import_module(module.strip())
+        for attr in filter(None, attrs.strip().split('.')):
+            obj = getattr(obj, attr)
+        return obj
     return s
+
+class lazy_import(object):
+    """
+    A class attribute which is imported with import_string() when first
+    accessed so optional backends are only loaded if they are used. It can
+    be overriden in instances (eg: to inject mocks).
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls=None):
+        return import_string(self.name)
+
+CHUNK_SIZE = 64*1024
+
+class FileChunks(object):
+    """
+    The contents of the file at `path` as an iterable of chunks which is
+    only read while iterating. The path is kept so stages which need a real
+    file can use it instead of copying the chunks.
+    """
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+class ChunkReader(object):
+    """
+    A read-only file-like object over an iterable of chunks, so streams can
+    be passed to code which expects a file.
+
+        >>> f = ChunkReader(['ab', 'cde', '', 'f'])
+        >>> f.read(2), f.read(2), f.read()
+        ('ab', 'cd', 'ef')
+        >>> f.read(1)
+        ''
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + ''.join(self._chunks)
+            self._buffer = ''
+            return data
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
@@ -12,10 +12,10 @@ setup(name='FTPRelayer',
     author_email='alberto@meteogrid.com',
     url='https://github.com/meteogrid/FTPRelayer',
     license='BSD3',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
     test_suite = "nose.collector",
-    zip_safe=True,
+    zip_safe=False,
     dependency_links = [
     ],
     install_requires=[
@@ -25,8 +25,9 @@ setup(name='FTPRelayer',
        "davclient",
     ],
     extras_require = {
+        "sftp": ["paramiko"],
     },
-    tests_require = ["nose", "unittest2", "mox"],
+    tests_require = ["nose", "unittest2", "mox", "paramiko"],
     entry_points="""
     [console_scripts]
     ftprelayer = ftprelayer:main